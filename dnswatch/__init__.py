@@ -3,17 +3,34 @@
 __version__ = "0.6.0"
 
 __all__ = [
+    "addresses",
+    "aliases",
     "aws",
+    "bootcache",
     "cloud",
     "config",
     "core",
+    "deadline",
     "dhclient",
     "dnsops",
     "dnsproviders",
+    "engine",
+    "fleet",
     "gce",
     "instance_info",
+    "journal",
     "killer",
+    "leaseevents",
+    "logfilter",
     "main",
+    "memwatch",
     "misc",
+    "notify",
+    "profiler",
+    "ratelimit",
+    "recorder",
     "route53",
+    "sweeper",
+    "ttl",
+    "zonesnapshot",
 ]
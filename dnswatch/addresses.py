@@ -0,0 +1,122 @@
+import re
+import socket
+import struct
+import logging
+
+from subprocess import check_output, CalledProcessError
+from misc import Misc
+from recorder import observe
+
+
+class Addresses:
+    """
+    Secondary IPv4 addresses of host to publish besides its private IP.
+
+    Addresses are taken from interfaces matching name filters and kept if
+    they belong to allowed networks, plus every address of delegated
+    ranges. Every address gets A record named by template in zone and PTR
+    record pointing to it.
+    """
+
+    def __init__(self, config):
+        self.logger = logging.getLogger("DNSWatch.Addresses")
+        self.misc = Misc(self.logger)
+        self.enabled = config["enabled"]
+        self.template = config["name"]
+        self.max = config["max"]
+        self.interfaces = [ re.compile(regex) for regex in config["interfaces"] ]
+        self.exclude_interfaces = [
+            re.compile(regex) for regex in config["exclude_interfaces"] ]
+        self.cidrs = [ self._parse_cidr(cidr) for cidr in config["cidrs"] ]
+        self.exclude_cidrs = [ self._parse_cidr(cidr) for cidr in config["exclude_cidrs"] ]
+        self.ranges = [ self._parse_cidr(cidr) for cidr in config["ranges"] ]
+        for cidr, (address, mask) in zip(config["ranges"], self.ranges):
+            if (~mask & 0xffffffff) >= self.max:
+                self.misc.die("Range {} is larger than {} addresses".format(cidr, self.max))
+        self.last = list()
+
+    def collect(self, exclude=()):
+        """Return sorted addresses to publish, except excluded ones"""
+        if not self.enabled:
+            return list()
+        try:
+            addresses = set(self._interface_addresses())
+        except (OSError, CalledProcessError) as e:
+            # Unpublishing all addresses because of failed listing is worse
+            self.logger.error("Failed to list addresses, keeping previous ones: %s.", e)
+            return self.last
+        for network in self.ranges:
+            addresses.update(self._expand(network))
+        addresses.difference_update(exclude)
+
+        addresses = sorted(addresses, key=self._to_int)
+        if len(addresses) > self.max:
+            self.logger.error("Found %s addresses, publishing only first %s.",
+                len(addresses), self.max)
+            addresses = addresses[:self.max]
+        self.logger.debug("Secondary addresses: %s.", len(addresses))
+        self.last = addresses
+        return addresses
+
+    def get_name(self, hostname, ip):
+        """Return name of address relative to zone"""
+        return self.template.format(hostname=hostname, ip=ip.replace(".", "-"))
+
+    def _interface_addresses(self):
+        output = observe(
+            "addresses", lambda: check_output(["ip", "-o", "-4", "addr", "show"]))
+        for line in output.splitlines():
+            # 2: eth0    inet 10.0.0.5/24 brd 10.0.0.255 scope global eth0
+            fields = line.split()
+            if len(fields) < 4 or fields[2] != "inet":
+                continue
+            interface = fields[1]
+            ip = fields[3].split("/")[0]
+            if not [ regex for regex in self.interfaces if regex.search(interface) ]:
+                continue
+            if [ regex for regex in self.exclude_interfaces if regex.search(interface) ]:
+                continue
+            if self.cidrs and not self._in_networks(ip, self.cidrs):
+                continue
+            if self._in_networks(ip, self.exclude_cidrs):
+                continue
+            yield ip
+
+    def _expand(self, network):
+        """Return usable addresses of network"""
+        address, mask = network
+        first = address
+        last = address | (~mask & 0xffffffff)
+        if last - first > 1:
+            # Skip network and broadcast addresses
+            first += 1
+            last -= 1
+        return [ self._to_ip(value) for value in xrange(first, last + 1)
+                    if not self._in_networks(self._to_ip(value), self.exclude_cidrs) ]
+
+    def _in_networks(self, ip, networks):
+        value = self._to_int(ip)
+        for address, mask in networks:
+            if value & mask == address:
+                return True
+        return False
+
+    def _parse_cidr(self, cidr):
+        """Return (network address, mask) as integers"""
+        try:
+            address, prefix = (cidr.split("/", 1) + ["32"])[:2]
+            prefix = int(prefix)
+            if not 0 <= prefix <= 32:
+                raise ValueError("bad prefix length")
+            mask = (0xffffffff << (32 - prefix)) & 0xffffffff
+            return self._to_int(address) & mask, mask
+        except (ValueError, socket.error) as e:
+            self.misc.die("Network {} isn't valid: {}".format(cidr, e))
+
+    @staticmethod
+    def _to_int(ip):
+        return struct.unpack("!I", socket.inet_aton(ip))[0]
+
+    @staticmethod
+    def _to_ip(value):
+        return socket.inet_ntoa(struct.pack("!I", value))
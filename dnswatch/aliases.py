@@ -0,0 +1,129 @@
+import re
+import logging
+
+from misc import Misc
+
+
+class AliasIndex:
+    """
+    Alias rules of dnsupdate.alias compiled once at config load.
+
+    Rules are bucketed by the literal prefix of their regex, so a lookup
+    only tries rules whose prefix the hostname starts with. Each bucket is
+    one combined regex, unless its rules use numeric backreferences. When
+    several rules match, the one with the longest literal prefix wins, then
+    the one with the smallest pattern text.
+    """
+
+    # Characters which end literal prefix of regex
+    SPECIAL = set(".^$*+?{}[]\\|()")
+    QUANTIFIERS = set("*+?{")
+    # Numeric backreference, unescaped backslash followed by digit
+    BACKREFERENCE = re.compile(r"(?:^|[^\\])(?:\\\\)*\\[1-9]")
+
+    def __init__(self, alias_dict):
+        self.logger = logging.getLogger("DNSWatch.AliasIndex")
+        self.misc = Misc(self.logger)
+        self.buckets = dict()
+        self.lengths = list()
+        self.size = 0
+
+        rules = list()
+        for host_re, aliases in (alias_dict or dict()).iteritems():
+            rules.append(self._compile_rule(host_re, aliases))
+        for rule in rules:
+            self.buckets.setdefault(rule["prefix"], list()).append(rule)
+        for prefix, bucket in self.buckets.iteritems():
+            bucket.sort(key=lambda rule: rule["pattern"])
+            self.buckets[prefix] = self._combine(bucket)
+        self.lengths = sorted(set(len(prefix) for prefix in self.buckets), reverse=True)
+        self.size = len(rules)
+        self.logger.debug("Compiled %s alias rules into %s buckets.",
+            self.size, len(self.buckets))
+
+    def lookup(self, hostname):
+        """Return aliases of the best rule matching hostname or None"""
+        for length in self.lengths:
+            if length > len(hostname):
+                continue
+            bucket = self.buckets.get(hostname[:length])
+            if not bucket:
+                continue
+            rule = self._match(bucket, hostname)
+            if rule:
+                self.logger.debug("Host %s matched alias rule '%s'.",
+                    hostname, rule["pattern"])
+                return rule["aliases"]
+        return None
+
+    def __len__(self):
+        return self.size
+
+    def _compile_rule(self, host_re, aliases):
+        if not isinstance(host_re, basestring):
+            self.misc.die("Alias rule {!r} isn't a string".format(host_re))
+        try:
+            regex = re.compile(host_re)
+        except re.error as e:
+            self.misc.die("Alias rule '{}' isn't a valid regex: {}".format(host_re, e))
+        if isinstance(aliases, basestring):
+            aliases = [aliases]
+        if (not isinstance(aliases, list) or not aliases
+            or not all(isinstance(alias, basestring) and alias for alias in aliases)):
+            self.misc.die("Aliases of rule '{}' must be a list of names".format(host_re))
+        return {"pattern": host_re, "regex": regex, "aliases": aliases,
+                "prefix": self._literal_prefix(host_re)}
+
+    def _literal_prefix(self, pattern):
+        """Return text every string matched by pattern starts with"""
+        # Top level alternation may start with anything
+        if "|" in pattern:
+            return ""
+        if pattern.startswith("^"):
+            pattern = pattern[1:]
+
+        prefix = list()
+        i = 0
+        while i < len(pattern):
+            char = pattern[i]
+            if char == "\\" and i + 1 < len(pattern) and not pattern[i + 1].isalnum():
+                literal = pattern[i + 1]
+                i += 2
+            elif char in self.SPECIAL:
+                break
+            else:
+                literal = char
+                i += 1
+            # Quantified character is optional or repeated
+            if i < len(pattern) and pattern[i] in self.QUANTIFIERS:
+                break
+            prefix.append(literal)
+        return "".join(prefix)
+
+    def _combine(self, bucket):
+        """Build one regex trying rules of bucket in order"""
+        # Wrapping groups renumber the ones of rules, backreferences would break
+        if [ rule for rule in bucket if self.BACKREFERENCE.search(rule["pattern"]) ]:
+            return {"regex": None, "rules": bucket}
+        combined = "|".join(
+            "(?P<rule{}>{})".format(index, rule["pattern"]) for index, rule in enumerate(bucket))
+        try:
+            regex = re.compile(combined)
+        except (re.error, AssertionError):
+            # Rules with own named groups, inline flags or too many groups
+            return {"regex": None, "rules": bucket}
+        return {"regex": regex, "rules": bucket}
+
+    def _match(self, bucket, hostname):
+        if bucket["regex"] is None:
+            for rule in bucket["rules"]:
+                if rule["regex"].match(hostname):
+                    return rule
+            return None
+
+        match = bucket["regex"].match(hostname)
+        if not match:
+            return None
+        for index, rule in enumerate(bucket["rules"]):
+            if match.group("rule{}".format(index)) is not None:
+                return rule
@@ -13,11 +13,11 @@ class AWS:
             }
         self.cloud = Cloud(metadata)
 
-    def is_inside(self):
-        return self.cloud.is_inside()
+    def is_inside(self, deadline=None):
+        return self.cloud.is_inside(deadline)
 
-    def get_private_ip(self):
-        return self.cloud.get_data("local-ipv4").text
+    def get_private_ip(self, deadline=None):
+        return self.cloud.get_data("local-ipv4", deadline).text
 
-    def get_public_ip(self):
-        return self.cloud.get_data("public-ipv4").text
+    def get_public_ip(self, deadline=None):
+        return self.cloud.get_data("public-ipv4", deadline).text
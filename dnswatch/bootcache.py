@@ -0,0 +1,82 @@
+import os
+import json
+import tempfile
+import logging
+
+from recorder import observe
+
+
+class BootCache:
+    """
+    Cache of cloud provider and instance IPs valid within one boot.
+
+    Detection needs metadata server probes and DNS queries, but its
+    results can't change until reboot unless addresses of network
+    interfaces change. So they are stored with boot ID and local
+    addresses, and reused by respawns and reloads while both are the same.
+    """
+
+    BOOT_ID_FILE = "/proc/sys/kernel/random/boot_id"
+
+    def __init__(self, config):
+        self.logger = logging.getLogger("DNSWatch.BootCache")
+        self.enabled = config["enabled"]
+        self.cache_file = config["file"]
+
+    def load(self, local_ips):
+        """Return cached identity if it's of this boot and addresses"""
+        if not self.enabled:
+            return None
+        boot_id = self._get_boot_id()
+        if not boot_id or not os.path.isfile(self.cache_file):
+            return None
+
+        try:
+            with open(self.cache_file, "r") as cf:
+                cache = json.load(cf)
+        except (IOError, ValueError) as e:
+            self.logger.warning("Failed to load boot cache %s: %s.", self.cache_file, e)
+            return None
+
+        if cache.get("boot_id") != boot_id:
+            self.logger.debug("Boot cache is of previous boot.")
+            return None
+        if cache.get("local_ips") != local_ips:
+            self.logger.info("Local addresses changed, detecting instance again.")
+            return None
+        self.logger.debug("Using boot cache %s.", self.cache_file)
+        return cache.get("identity")
+
+    def save(self, identity, local_ips):
+        if not self.enabled:
+            return
+        boot_id = self._get_boot_id()
+        if not boot_id:
+            return
+        cache = {"boot_id": boot_id, "local_ips": local_ips, "identity": identity}
+
+        cache_dir = os.path.dirname(self.cache_file)
+        try:
+            if cache_dir and not os.path.isdir(cache_dir):
+                os.makedirs(cache_dir)
+            fd, tmp_file = tempfile.mkstemp(dir=cache_dir or ".", prefix=".bootcache-")
+            try:
+                with os.fdopen(fd, "w") as cf:
+                    json.dump(cache, cf, indent=2, sort_keys=True)
+                os.rename(tmp_file, self.cache_file)
+            except:
+                if os.path.exists(tmp_file):
+                    os.remove(tmp_file)
+                raise
+        except (IOError, OSError) as e:
+            self.logger.warning("Failed to save boot cache %s: %s.", self.cache_file, e)
+
+    def _get_boot_id(self):
+        return observe("boot_id", self._read_boot_id)
+
+    def _read_boot_id(self):
+        try:
+            with open(self.BOOT_ID_FILE, "r") as bf:
+                return bf.read().strip()
+        except IOError:
+            return None
@@ -1,20 +1,44 @@
 import requests
 import logging
 
+from recorder import interact
+
 class Cloud:
+    # Metadata server is link-local, don't wait longer for it
+    TIMEOUT = 2
 
     def __init__(self, metadata):
         self.logger = logging.getLogger("DNSWatch.Cloud")
         self.metadata = metadata
 
-    def is_inside(self):
-        return self.get_data("hostname").ok
+    def is_inside(self, deadline=None):
+        data = self.get_data("hostname", deadline)
+        return data is not None and data.ok
 
-    def get_data(self, path):
+    def get_data(self, path, deadline=None):
         data = None
         request = "{}/{}".format(self.metadata["url"], path)
+        timeout = self.TIMEOUT
+        if deadline:
+            timeout = deadline.timeout(timeout)
         try:
-            data = requests.get(request, headers=self.metadata["headers"])
-        except requests.exceptions.ConnectionError as e:
-            self.logger.error("Connection to {} failed: {}.".format(request, e[0][1]))
+            data = interact(
+                "metadata", request,
+                lambda: requests.get(
+                    request, headers=self.metadata["headers"], timeout=timeout),
+                encode=lambda response: {
+                    "status": response.status_code, "text": response.text},
+                decode=ReplayedResponse)
+        except (requests.exceptions.ConnectionError,
+                requests.exceptions.Timeout) as e:
+            self.logger.error("Connection to %s failed: %s.", request, e)
         return data
+
+
+class ReplayedResponse:
+    """Stand-in of metadata server response replayed from capture"""
+
+    def __init__(self, stored):
+        self.status_code = stored["status"]
+        self.text = stored["text"]
+        self.ok = self.status_code < 400
@@ -1,42 +1,58 @@
 import os
+import copy
+import hashlib
 import yaml
 import logging
 
+from aliases import AliasIndex
+from addresses import Addresses
+from misc import Misc
+from engine import Engine
+
+# libyaml parser is much faster when available
+try:
+    from yaml import CSafeLoader as SafeLoader
+except ImportError:
+    from yaml import SafeLoader
+
+# Watching config with inotify is optional, stat polling is used without it
+try:
+    import pyinotify
+except ImportError:
+    pyinotify = None
+
 class Config:
     def __init__(self):
         self.logger = logging.getLogger("DNSWatch.Config")
+        self.misc = Misc(self.logger)
         self.dnsprovider = None
         self.dnszone = None
+        self.dnszones = None
+        self.config_file = None
+        self.autoreload = False
+        # Parsed content of config file and its hash
+        self.digest = None
+        self.parsed = None
+        # Change detection state
+        self.notifier = None
+        self.touched = False
+        self.file_stat = None
 
     def read(self, config_file):
-        self.logger.debug("Loading configuration from {}".format(config_file))
-        with open(os.path.realpath(config_file), "r") as f:
-            config = yaml.load(f)
-
-        # For backward compatibility with 0.2.* config
-        if "nsupdate" in config:
-            config["dnsupdate"] = config.pop("nsupdate")
+        self.logger.debug("Loading configuration from %s", config_file)
+        config = self._load(config_file)
 
-        # DNS query timeout is optional
-        if not "timeout" in config["dnsupdate"]:
-            config["dnsupdate"]["timeout"] = 10
-
-        # TTL is optional
-        if not "ttl" in config["dnsupdate"]:
-            config["dnsupdate"]["ttl"] = 300
-
-        # Aliases is optional
-        if not "alias" in config["dnsupdate"]:
-            config["dnsupdate"]["alias"] = dict()
+        self._complete(config)
 
         # Do not rewrite DNS provider and zone under reload
         if self.dnsprovider:
             new_dnsprovider = config["dnsupdate"]["provider"]
             if self.dnsprovider != new_dnsprovider:
                 self.logger.warning(
-                    "DNS provider change ignored by reload: '{}' -> '{}'.".format(
-                        self.dnsprovider, new_dnsprovider))
+                    "DNS provider change ignored by reload: '%s' -> '%s'.",
+                        self.dnsprovider, new_dnsprovider)
                 config["dnsupdate"]["provider"] = self.dnsprovider
+                self._set_provider_defaults(config["dnsupdate"])
         else:
             self.dnsprovider = config["dnsupdate"]["provider"]
 
@@ -44,11 +60,348 @@ class Config:
             new_dnszone = config["dnsupdate"]["zone"]
             if self.dnszone != new_dnszone:
                 self.logger.warning(
-                    "DNS zone change ignored by reload: '{}' -> '{}'.".format(
-                        self.dnszone, new_dnszone))
+                    "DNS zone change ignored by reload: '%s' -> '%s'.",
+                        self.dnszone, new_dnszone)
                 config["dnsupdate"]["zone"] = self.dnszone
         else:
             self.dnszone = config["dnsupdate"]["zone"]
 
+        if self.dnszones is not None:
+            new_dnszones = config["dnsupdate"]["zones"]
+            if set(self.dnszones) != set(new_dnszones):
+                self.logger.warning(
+                    "Change of zones ignored by reload: %s -> %s.",
+                        sorted(self.dnszones), sorted(new_dnszones))
+                config["dnsupdate"]["zones"] = self.dnszones
+            for zone, zone_config in config["dnsupdate"]["zones"].iteritems():
+                if zone_config["provider"] != self.dnszones[zone]["provider"]:
+                    self.logger.warning(
+                        "DNS provider change of zone %s ignored by reload: '%s' -> '%s'.",
+                            zone, self.dnszones[zone]["provider"], zone_config["provider"])
+                    zone_config["provider"] = self.dnszones[zone]["provider"]
+                    self._set_provider_defaults(zone_config)
+        self.dnszones = config["dnsupdate"]["zones"]
+
+        # Reload on change of config file is optional
+        if not "autoreload" in config:
+            config["autoreload"] = True
+        self.autoreload = config["autoreload"]
+        if self.autoreload and self.config_file != config_file:
+            self.config_file = config_file
+            self._watch_file()
+
         self.logger.debug("Configuration loaded.")    
         return config
+
+    def _complete(self, config):
+        """Fill optional options with defaults and validate config"""
+        # For backward compatibility with 0.2.* config
+        if "nsupdate" in config:
+            config["dnsupdate"] = config.pop("nsupdate")
+
+        for option in ["provider", "zone"]:
+            if not option in config["dnsupdate"]:
+                self.misc.die("Option dnsupdate.{} is required".format(option))
+        self._set_dnsupdate_defaults(config["dnsupdate"])
+        self._set_provider_defaults(config["dnsupdate"])
+
+        # Additional zones are optional, every zone has dnsupdate options
+        # overridden by its own ones
+        if not config["dnsupdate"].get("zones"):
+            config["dnsupdate"]["zones"] = dict()
+        zones = dict()
+        for zone, overrides in config["dnsupdate"]["zones"].iteritems():
+            if zone == config["dnsupdate"]["zone"]:
+                self.misc.die("Zone {} is listed in zones and as main zone".format(zone))
+            zone_config = dict(config["dnsupdate"])
+            zone_config.pop("zones")
+            zone_config.update(overrides or dict())
+            zone_config["zone"] = zone
+            self._set_dnsupdate_defaults(zone_config)
+            self._set_provider_defaults(zone_config)
+            zones[zone] = zone_config
+        config["dnsupdate"]["zones"] = zones
+
+        # Journal of published records is optional
+        if not "journal" in config:
+            config["journal"] = dict()
+        if not "enabled" in config["journal"]:
+            config["journal"]["enabled"] = True
+        if not "file" in config["journal"]:
+            config["journal"]["file"] = "/var/lib/dnswatch/journal.json"
+
+        # Boot cache of cloud detection is optional, it's on by default
+        if not "bootcache" in config:
+            config["bootcache"] = dict()
+        if not "enabled" in config["bootcache"]:
+            config["bootcache"]["enabled"] = True
+        if not "file" in config["bootcache"]:
+            config["bootcache"]["file"] = "/var/lib/dnswatch/bootcache.json"
+
+        # Ordering of DNS slaves in local resolver is optional
+        if not "resolver" in config:
+            config["resolver"] = dict()
+        for option, default in [("probe", True), ("probe_timeout", 1),
+                                ("max_failures", 3), ("min_gain", 5),
+                                ("gain_ratio", 0.2)]:
+            if not option in config["resolver"]:
+                config["resolver"][option] = default
+
+        # Waiting for propagation of records to slaves is optional
+        if not "propagation" in config:
+            config["propagation"] = dict()
+        for option, default in [("wait", False), ("timeout", 60),
+                                ("interval", 2), ("ready_file", None)]:
+            if not option in config["propagation"]:
+                config["propagation"][option] = default
+
+        # Fleet registration mode is optional
+        if not "fleet" in config:
+            config["fleet"] = dict()
+        for option, default in [("batch", 100), ("workers", 4), ("timeout", 60),
+                                ("view", "private"), ("ptr", True)]:
+            if not option in config["fleet"]:
+                config["fleet"][option] = default
+
+        # Heartbeat record marking live hosts is optional
+        if not "heartbeat" in config:
+            config["heartbeat"] = dict()
+        for option, default in [("enabled", True), ("interval", 3600)]:
+            if not option in config["heartbeat"]:
+                config["heartbeat"][option] = default
+
+        # Sweeping of records left by dead hosts is optional
+        if not "sweeper" in config:
+            config["sweeper"] = dict()
+        for option, default in [("max_age", 86400), ("batch", 50), ("timeout", 60),
+                                ("view", "private"),
+                                ("state_dir", "/var/lib/dnswatch/sweeper")]:
+            if not option in config["sweeper"]:
+                config["sweeper"][option] = default
+
+        # Engine running independent network calls of a cycle is optional
+        if not "engine" in config:
+            config["engine"] = "serial"
+        if not config["engine"] in Engine.MODES:
+            self.misc.die("Engine {} isn't supported, use one of: {}".format(
+                config["engine"], ", ".join(Engine.MODES)))
+
+        # Profiling settings are optional, profiling is off by default
+        if not "profile" in config:
+            config["profile"] = dict()
+        for option, default in [("dir", "/var/lib/dnswatch/profile"), ("keep", 20),
+                                ("top", 30), ("sort", "cumulative"), ("ticks", 10)]:
+            if not option in config["profile"]:
+                config["profile"][option] = default
+
+        # Secondary addresses are optional and off by default
+        if not "addresses" in config:
+            config["addresses"] = dict()
+        for option, default in [("enabled", False), ("interfaces", [".*"]),
+                                ("exclude_interfaces", ["^lo$"]), ("cidrs", list()),
+                                ("exclude_cidrs", list()), ("ranges", list()),
+                                ("name", "{hostname}-{ip}"), ("max", 4096)]:
+            if not option in config["addresses"]:
+                config["addresses"][option] = default
+
+        # DHCP lease events from dhclient hook are optional and off by default
+        if not "lease_events" in config:
+            config["lease_events"] = dict()
+        for option, default in [("enabled", False),
+                                ("fifo", "/run/dnswatch/lease-events"),
+                                ("hook", "/etc/dhcp/dhclient-exit-hooks.d/dnswatch"),
+                                ("poll", 300)]:
+            if not option in config["lease_events"]:
+                config["lease_events"][option] = default
+
+        # NOTIFY listener is optional, discovery is polled every watch without it
+        if not "notify" in config:
+            config["notify"] = dict()
+        for option, default in [("enabled", False), ("address", "0.0.0.0"),
+                                ("port", 53), ("poll", 3600)]:
+            if not option in config["notify"]:
+                config["notify"][option] = default
+
+        # Memory instrumentation is optional and off by default
+        if not "memory" in config:
+            config["memory"] = dict()
+        for option, default in [("enabled", False), ("top", 10), ("frames", 1)]:
+            if not option in config["memory"]:
+                config["memory"][option] = default
+
+        # Startup & reload jitter is optional
+        if not "jitter" in config:
+            config["jitter"] = dict()
+        for option in ["startup", "reload"]:
+            if not option in config["jitter"]:
+                config["jitter"][option] = 0
+
+        # Deadlines of startup, reload and every watch tick are optional
+        if not "deadline" in config:
+            config["deadline"] = dict()
+        for option, default in [("startup", 120), ("reload", 120), ("watch", 60)]:
+            if not option in config["deadline"]:
+                config["deadline"][option] = default
+
+        # Cleanup deadline is optional; keep it below service stop timeout
+        if not "cleanup" in config:
+            config["cleanup"] = dict()
+        if not "timeout" in config["cleanup"]:
+            config["cleanup"]["timeout"] = 4
+
+        # Parse address filters once, so bad ones fail loading of config
+        Addresses(config["addresses"])
+
+    def _set_dnsupdate_defaults(self, dnsupdate):
+        """Fill optional dnsupdate options of zone"""
+        # DNS query timeout is optional
+        if not "timeout" in dnsupdate:
+            dnsupdate["timeout"] = 10
+
+        # TTL is optional
+        if not "ttl" in dnsupdate:
+            dnsupdate["ttl"] = 300
+
+        # Adaptive TTL is optional, static TTL above is used without it
+        if not "adaptive_ttl" in dnsupdate:
+            dnsupdate["adaptive_ttl"] = dict()
+        adaptive_ttl = dnsupdate["adaptive_ttl"]
+        for option, default in [("enabled", False), ("min", 60), ("max", 3600),
+                                ("factor", 2)]:
+            if not option in adaptive_ttl:
+                adaptive_ttl[option] = default
+        if adaptive_ttl["enabled"] and adaptive_ttl["min"] > adaptive_ttl["max"]:
+            self.misc.die("Minimal adaptive TTL is greater than maximal one")
+
+        # Rate limit of requests to DNS masters or Route53 is optional
+        if not "ratelimit" in dnsupdate:
+            dnsupdate["ratelimit"] = dict()
+        ratelimit = dnsupdate["ratelimit"]
+        for option, default in [("rate", 10), ("burst", 20), ("retries", 3),
+                                ("backoff", 1), ("max_backoff", 30)]:
+            if not option in ratelimit:
+                ratelimit[option] = default
+
+        # Records per DNS UPDATE or Route53 change batch are optional
+        if not "batch" in dnsupdate:
+            dnsupdate["batch"] = 100
+
+        # DNS UPDATE transport is optional
+        if not "transport" in dnsupdate:
+            dnsupdate["transport"] = dict()
+        transport = dnsupdate["transport"]
+        for option, default in [("protocol", "auto"), ("udp_timeout", 2),
+                                ("udp_retries", 2), ("masters", dict())]:
+            if not option in transport:
+                transport[option] = default
+
+        # Aliases is optional
+        if not "alias" in dnsupdate:
+            dnsupdate["alias"] = dict()
+        # Compile alias rules once, so bad ones fail loading of config
+        dnsupdate["alias_index"] = AliasIndex(dnsupdate["alias"])
+
+    def _set_provider_defaults(self, dnsupdate):
+        """
+        Compile dnsupdate options of every provider of zone listing several:
+        options of zone overridden by the ones of provider
+        """
+        dnsupdate["providers"] = dict()
+        if not isinstance(dnsupdate["provider"], list):
+            return
+        for name in dnsupdate["provider"]:
+            provider_config = dict(dnsupdate)
+            provider_config.pop("providers")
+            provider_config.pop("zones", None)
+            provider_config.update(dnsupdate.get(name) or dict())
+            provider_config["provider"] = name
+            self._set_dnsupdate_defaults(provider_config)
+            dnsupdate["providers"][name] = provider_config
+
+    def changed(self):
+        """Tell if content of config file changed since it was read"""
+        if not self.autoreload or not self._file_touched():
+            return False
+
+        try:
+            digest, content = self._read_file(self.config_file)
+        except IOError as e:
+            self.logger.warning("Failed to read config %s: %s.", self.config_file, e)
+            return False
+        if digest == self.digest:
+            self.logger.debug("Config file touched, but its content is the same.")
+            return False
+
+        # Keep running with old config if new one is broken
+        try:
+            parsed = yaml.load(content, Loader=SafeLoader)
+            self._complete(copy.deepcopy(parsed))
+        except (Exception, SystemExit) as e:
+            self.logger.error("Changed config %s isn't valid, ignoring it: %s.",
+                self.config_file, e)
+            return False
+        self.digest = digest
+        if parsed == self.parsed:
+            self.logger.debug("Only formatting of config file changed.")
+            return False
+        self.parsed = parsed
+        self.logger.info("Config file %s changed.", self.config_file)
+        return True
+
+    def _load(self, config_file):
+        """Parse config file unless its content is the same as parsed before"""
+        digest, content = self._read_file(config_file)
+        if digest != self.digest:
+            self.parsed = yaml.load(content, Loader=SafeLoader)
+            self.digest = digest
+        else:
+            self.logger.debug("Config content is the same, skipping parsing.")
+        # Defaults get filled in, keep parsed content intact
+        return copy.deepcopy(self.parsed)
+
+    def _read_file(self, config_file):
+        with open(os.path.realpath(config_file), "r") as f:
+            content = f.read()
+        return hashlib.sha1(content).hexdigest(), content
+
+    def _watch_file(self):
+        self.file_stat = self._stat_file()
+        if not pyinotify:
+            self.logger.debug("Polling config %s for changes.", self.config_file)
+            return
+
+        config = self
+
+        class Handler(pyinotify.ProcessEvent):
+            def process_default(self, event):
+                config.touched = True
+
+        # Watch directory: config management usually replaces file by rename
+        watch_manager = pyinotify.WatchManager()
+        self.notifier = pyinotify.Notifier(watch_manager, Handler())
+        watch_manager.add_watch(
+            os.path.dirname(os.path.abspath(self.config_file)),
+            pyinotify.IN_CLOSE_WRITE | pyinotify.IN_MOVED_TO | pyinotify.IN_CREATE)
+        self.logger.debug("Watching config %s with inotify.", self.config_file)
+
+    def _file_touched(self):
+        if self.notifier:
+            if self.notifier.check_events(timeout=0):
+                self.notifier.read_events()
+                self.notifier.process_events()
+            touched = self.touched
+            self.touched = False
+            return touched
+
+        file_stat = self._stat_file()
+        if file_stat == self.file_stat:
+            return False
+        self.file_stat = file_stat
+        return True
+
+    def _stat_file(self):
+        try:
+            st = os.stat(self.config_file)
+        except OSError:
+            return None
+        return (st.st_ino, st.st_size, st.st_mtime)
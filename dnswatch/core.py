@@ -1,8 +1,14 @@
 import time
+import errno
+import select
 import logging
 
 from instance_info import InstanceInfo
-from dnsproviders import BindProvider, Route53Provider
+from bootcache import BootCache
+from dnsproviders import Provider, BindProvider, Route53Provider, MultiProvider
+from journal import Journal
+from deadline import Deadline, DeadlineExceeded
+from engine import Engine
 from gce import GCE
 from aws import AWS
 from killer import Killer
@@ -10,47 +16,76 @@ from misc import Misc
 
 
 class DNSWatch:
-    def __init__(self, config):
+    def __init__(self, config, deadline=None, profiler=None, memwatch=None,
+                 lease_events=None, notify_listener=None):
         self.logger = logging.getLogger("DNSWatch.Main")
-
-        # Detect cloud provider
-        provider = self._detect_provider()
+        self.config = config
+        self.profiler = profiler
+        self.memwatch = memwatch
+        self.lease_events = lease_events
+        self.notify_listener = notify_listener
+        # Discovery is polled every watch tick unless NOTIFY listener works
+        config["notify"]["enabled"] = bool(notify_listener and notify_listener.enabled)
+        self.engine = Engine(config["engine"])
 
         # Add private & public IPs into config
-        ii = InstanceInfo(provider)
-        private_ip = ii.get_private_ip()
-        public_ip = ii.get_public_ip()
+        ii = InstanceInfo()
+        private_ip, public_ip = self._get_identity(ii, deadline)
         hostname = ii.get_hostname()
         fqdn = "{}.{}".format(hostname, config["dnsupdate"]["zone"])
         config["host"] = {
             "fqdn": fqdn,
             "private_ip": private_ip,
-            "public_ip": public_ip
+            "public_ip": public_ip,
+            "hostname": hostname,
+            "primary": True
         }
 
-        # Select DNS provider
-        dns_provider = config["dnsupdate"]["provider"]
-        self.logger.info("DNS provider is: {}.".format(dns_provider))
-        if dns_provider == "bind":
-            self.dp = BindProvider(config)
-        elif dns_provider == "route53":
-            self.dp = Route53Provider(config)
+        # Load journal of published records
+        journal = Journal(config["journal"])
+
+        # Select DNS provider of every zone
+        zones = [ (config["dnsupdate"]["zone"], config) ]
+        for zone in sorted(config["dnsupdate"]["zones"]):
+            zones.append((zone, self._zone_config(config, zone, hostname)))
+        if len(zones) > 1:
+            self.logger.info("DNS zones are: %s.", ", ".join(zone for zone, _ in zones))
+
+        providers = list()
+        for zone, zone_config in zones:
+            dns_provider = zone_config["dnsupdate"]["provider"]
+            if isinstance(dns_provider, list):
+                self.logger.info("DNS providers of %s are: %s.", zone, ", ".join(dns_provider))
+            else:
+                self.logger.info("DNS provider of %s is: %s.", zone, dns_provider)
+            for name, provider_config in Provider()._provider_configs(zone_config):
+                provider = self._make_provider(name, provider_config, journal)
+                if provider:
+                    if len(zones) > 1:
+                        name = "{}@{}".format(name, zone)
+                    providers.append((name, provider))
+
+        if len(providers) == 1 and not isinstance(config["dnsupdate"]["provider"], list):
+            self.dp = providers[0][1]
         else:
-            self.logger.error("DNS provider {} isn't supported.".format(dns_provider))
+            # Zones and providers are updated concurrently
+            self.dp = MultiProvider(providers, config["propagation"])
 
-    def initial_config(self):
+    def initial_config(self, deadline=None):
         self.logger.info("Doing initial configuration.")
-        self.dp.initial_config()
+        self.dp.initial_config(deadline)
 
-    def reload_config(self):
+    def reload_config(self, deadline=None):
         self.logger.info("Doing reload of configuration.")
-        self.dp.reload_config()
+        self.dp.reload_config(deadline)
 
-    def watch(self, pause=10):
+    def watch(self, pause=10, config_changed=None):
         self.logger.info("Starting watch.")
         killer = Killer()
+        last_tick = time.time()
+        self._update_notify_sources()
         while True:
-            time.sleep(pause)
+            events, notified = self._wait_for_events(pause)
             if killer.kill_now:
                 self.logger.info("Got kill signal, finishing watch.")
                 if killer.cleanup:
@@ -62,25 +97,141 @@ class DNSWatch:
             if killer.reload_now:
                 self.logger.info("Got reload signal, finishing watch.")
                 return "reload"
+            elif config_changed and config_changed():
+                self.logger.info("Config changed, finishing watch.")
+                return "reload"
+            elif self._address_changed(events):
+                self.logger.info("DHCP lease got new address, finishing watch.")
+                return "reload"
+            elif (not events and not notified
+                    and time.time() - last_tick < self._poll_interval(pause)):
+                continue
             else:
+                last_tick = time.time()
+                if notified:
+                    self.dp.rediscover(notified)
                 self.logger.debug("Sending new watcher.")	
-                self.dp.watch()
+                deadline = Deadline("watch", self.config["deadline"]["watch"])
+                try:
+                    if self.profiler:
+                        self.profiler.run("watch", self.dp.watch, deadline)
+                    else:
+                        self.dp.watch(deadline)
+                except DeadlineExceeded as e:
+                    self.logger.warning("%s, skipping the rest of watch tick.", e)
+                if self.memwatch:
+                    self.memwatch.tick()
+                self._update_notify_sources()
+
+    def _wait_for_events(self, pause):
+        """
+        Sleep for pause, return lease events and zones of NOTIFY messages
+        if they come earlier.
+        """
+        sources = [ source for source in [self.lease_events, self.notify_listener]
+                        if source and source.enabled ]
+        if not sources:
+            time.sleep(pause)
+            return list(), list()
+        try:
+            readable = select.select(sources, [], [], pause)[0]
+        except select.error as e:
+            if e.args[0] != errno.EINTR:
+                raise
+            # Signal came, let watch handle it
+            return list(), list()
+
+        events = list()
+        if self.lease_events in readable:
+            events = self.lease_events.read()
+        notified = list()
+        if self.notify_listener in readable:
+            notified = self.notify_listener.read()
+        return events, notified
 
-    def cleanup(self):
+    def _update_notify_sources(self):
+        """Accept NOTIFY from masters found by last discovery"""
+        if self.notify_listener and self.notify_listener.enabled:
+            self.notify_listener.set_sources(self.dp.notify_sources())
+
+    def _poll_interval(self, pause):
+        """Seconds between watch ticks not caused by lease events"""
+        if not self.lease_events or not self.lease_events.enabled:
+            return pause
+        return max(pause, self.config["lease_events"]["poll"])
+
+    def _address_changed(self, events):
+        """Tell if lease events moved host to other address"""
+        for event in events:
+            new_ip = event.get("new_ip")
+            if new_ip and new_ip != event.get("old_ip") \
+                    and new_ip != self.config["host"]["private_ip"]:
+                return True
+        return False
+
+    def cleanup(self, deadline):
         self.logger.info("Cleaning DNS before shutdown.")
-        self.dp.cleanup()
+        self.dp.cleanup(deadline)
         self.logger.info("Cleanup finished.")
 
-    def _detect_provider(self):
+    def _make_provider(self, name, config, journal):
+        if name == "bind":
+            return BindProvider(config, journal)
+        elif name == "route53":
+            return Route53Provider(config, journal)
+        else:
+            self.logger.error("DNS provider %s isn't supported.", name)
+
+    def _zone_config(self, config, zone, hostname):
+        """Return config of additional zone sharing host's addresses"""
+        zone_config = dict(config)
+        zone_config["dnsupdate"] = config["dnsupdate"]["zones"][zone]
+        zone_config["host"] = dict(config["host"])
+        zone_config["host"]["fqdn"] = "{}.{}".format(hostname, zone)
+        # Local resolver and PTR records belong to main zone only
+        zone_config["host"]["primary"] = False
+        return zone_config
+
+    def _get_identity(self, ii, deadline=None):
+        """Return private & public IPs, detected once per boot"""
+        boot_cache = BootCache(self.config["bootcache"])
+        local_ips = ii.get_local_ips()
+        identity = boot_cache.load(local_ips)
+        if identity:
+            self.logger.info("My cloud provider is: %s (cached).", identity["provider"])
+            return identity["private_ip"], identity["public_ip"]
+
+        # Detect cloud provider
+        provider = self._detect_provider(deadline)
+
+        ii = InstanceInfo(provider)
+        private_ip, public_ip = self.engine.run(
+            [(ii.get_private_ip, [deadline]), (ii.get_public_ip, [deadline])], deadline)
+        # Failed lookups are retried on next start
+        if private_ip and public_ip:
+            boot_cache.save(
+                {"provider": provider, "private_ip": private_ip, "public_ip": public_ip},
+                local_ips)
+        return private_ip, public_ip
+
+    def _detect_provider(self, deadline=None):
         self.logger.info("Detecting cloud provider.")
         provider = "other"
         gce = GCE()
         aws = AWS()
 
-        if gce.is_inside():
+        if self.engine.mode == "concurrent":
+            # Ask both metadata servers at once instead of waiting for timeout
+            inside_gce, inside_aws = self.engine.run(
+                [(gce.is_inside, [deadline]), (aws.is_inside, [deadline])], deadline)
+        else:
+            inside_gce = gce.is_inside(deadline)
+            inside_aws = not inside_gce and aws.is_inside(deadline)
+
+        if inside_gce:
             provider = "gce"
-        elif aws.is_inside():
+        elif inside_aws:
             provider = "aws"
         
-        self.logger.info("My cloud provider is: {}.".format(provider))
+        self.logger.info("My cloud provider is: %s.", provider)
         return provider
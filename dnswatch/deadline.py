@@ -0,0 +1,33 @@
+import time
+import logging
+
+
+class DeadlineExceeded(Exception):
+    pass
+
+
+class Deadline:
+    """
+    Time budget of one phase (startup, watch tick, reload, cleanup).
+    Every network call of the phase gets what is left of it as timeout.
+    """
+
+    def __init__(self, phase, budget):
+        self.logger = logging.getLogger("DNSWatch.Deadline")
+        self.phase = phase
+        self.budget = budget
+        self.expires = time.time() + budget
+
+    def remaining(self):
+        return max(0, self.expires - time.time())
+
+    def timeout(self, limit=None):
+        """Return timeout for next call, but not more than limit"""
+        remaining = self.remaining()
+        if remaining == 0:
+            raise DeadlineExceeded(
+                "Deadline of {} phase ({} seconds) exceeded".format(
+                    self.phase, self.budget))
+        if limit is not None and limit < remaining:
+            return limit
+        return remaining
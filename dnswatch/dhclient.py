@@ -31,18 +31,18 @@ class DHClient:
                 'eth0']
         for proc in psutil.process_iter():
             if re.match("^dhclient\d*$", proc.name):
-                self.logger.debug("dhclient cmdline: '{}'.".format(
-                                    " ".join(proc.cmdline)))
+                self.logger.debug("dhclient cmdline: '%s'.",
+                                    " ".join(proc.cmdline))
                 return proc.cmdline
 
         self.logger.warning(
-            "dhclient process not found. Falling back to default: '{}'.".format(
-                " ".join(default_cmdline)))
+            "dhclient process not found. Falling back to default: '%s'.",
+                " ".join(default_cmdline))
         self._request_lease(default_cmdline)
         return default_cmdline
 
     def set_nameserver(self, ns):
-        self.logger.debug("Setting nameserver: {}.".format(ns))
+        self.logger.debug("Setting nameserver: %s.", ns)
         if not self._set_option("supersede", "domain-name-servers", ", ".join(ns)):
             self.misc.die("Failed to set nameserver for dhclient")
 
@@ -51,7 +51,7 @@ class DHClient:
         return self._get_option("domain-name-servers", otype="supersede")[2]
 
     def set_search(self, domain):
-        self.logger.debug("Setting search domain: {}.".format(domain))
+        self.logger.debug("Setting search domain: %s.", domain)
         if not self._set_option("prepend", "domain-name", '"{} "'.format(" ".join(domain))):
             self.misc.die("Failed to set search domain for dhclient")
 
@@ -93,12 +93,12 @@ class DHClient:
         for line in config:
             if re.match("^{}\s+{}\s+.*;$".format(otype, option), line):
                 option_exist = True
-                self.logger.debug("Option '{}' exist, checking value.".format(option))
+                self.logger.debug("Option '%s' exist, checking value.", option)
                 if re.match("^{}\s+{}\s+{};$".format(otype, option, value), line):
-                    self.logger.debug("Value '{}' is the same, skipping.".format(value))
+                    self.logger.debug("Value '%s' is the same, skipping.", value)
                     new_config.append(line)
                 else:
-                    self.logger.debug("Values differ, updating to '{}'.".format(value))
+                    self.logger.debug("Values differ, updating to '%s'.", value)
                     write_config = True
                     new_config.append(new_line)
                     continue
@@ -163,6 +163,6 @@ class DHClient:
 
     def _backup_config(self, config_file):
         backup_file = "{}.bak-{}".format(config_file, time.time())
-        self.logger.debug("Doing backup of {} to {}.".format(config_file, backup_file))
+        self.logger.debug("Doing backup of %s to %s.", config_file, backup_file)
         copyfile(config_file, backup_file)
         return True
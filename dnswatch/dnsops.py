@@ -1,21 +1,43 @@
 import re
+import time
+import threading
 import dns.resolver
 import dns.tsigkeyring
 import dns.update
 import dns.reversename
+import dns.rcode
+import dns.flags
+import dns.query
+import dns.message
+import dns.rdatatype
+import dns.name
 import logging
 
+from collections import OrderedDict
 from misc import Misc
+from ratelimit import shared_limiter
+from deadline import DeadlineExceeded
+from engine import Engine
+from recorder import interact
+from zonesnapshot import ZoneSnapshot
 
 
 class DNSOps:
 
-    def __init__(self, config):
+    def __init__(self, config, engine=None):
         self.logger = logging.getLogger("DNSWatch.DNSOps")
         self.misc = Misc(self.logger)
         self.config = config
+        self.engine = engine or Engine()
         self.keyring = None
         self.key_algorithm = None
+        self.limiter = shared_limiter("bind", config["ratelimit"])
+        # Reverse zones found by SOA queries at master: (master, prefix) -> origin
+        self.reverse_zones = dict()
+        # Names under classless delegation: (master, name) -> [owner, origin]
+        self.delegated_names = dict()
+        # Prefixes with classless delegation, looked up name by name
+        self.classless_prefixes = set()
 
     def setup_key(self):
         update_key = self.config["update_key"]
@@ -24,104 +46,331 @@ class DNSOps:
         algorithm = update_key["algorithm"]
 
         self.logger.debug(
-            "Creating keyring for domain '{}' with key '{}...'.".format(
-                name, key[:10]))
+            "Creating keyring for domain '%s' with key '%s...'.",
+                name, key[:10])
         self.keyring = dns.tsigkeyring.from_text({name: key}) 
 
-        self.logger.debug("Setting key algorithm to '{}'.".format(algorithm))
+        self.logger.debug("Setting key algorithm to '%s'.", algorithm)
         self.key_algorithm = getattr(dns.tsig, algorithm)
 
-    def get_masters(self):
+    def get_masters(self, deadline=None):
         zone = self.config["zone"]
-        self.logger.debug("Getting DNS masters for zone {}.".format(zone))
+        self.logger.debug("Getting DNS masters for zone %s.", zone)
 
-        masters = dict()
-        for mtype in ["private", "public"]:
-            try:
-                record = "dns-master-{}.{}".format(mtype, zone)
-                self.logger.debug("Looking for TXT record {}.".format(record))
-                answer = self._query(record, "TXT")
-            except dns.resolver.NXDOMAIN:
-                upper_zone = zone.split(".", 1)[1]
-                record = "dns-master-{}.{}".format(mtype, upper_zone)
-                self.logger.debug(
-                    "Failed. Checking upper zone {}.".format(upper_zone))
-                answer = self._query(record, "TXT")
-
-            self.logger.debug("Got {} masters: {}.".format(mtype, answer))
-            masters[mtype] = answer
+        mtypes = ["private", "public"]
+        answers = self.engine.run(
+            [ (self._get_masters_of_type, [zone, mtype, deadline]) for mtype in mtypes ],
+            deadline)
+        masters = dict(zip(mtypes, answers))
 
-        self.logger.debug("Masters: {}.".format(masters))
+        self.logger.debug("Masters: %s.", masters)
         return masters
 
-    def get_slaves(self, masters):
+    def _get_masters_of_type(self, zone, mtype, deadline=None):
+        try:
+            record = "dns-master-{}.{}".format(mtype, zone)
+            self.logger.debug("Looking for TXT record %s.", record)
+            answer = self._query(record, "TXT", deadline=deadline)
+        except dns.resolver.NXDOMAIN:
+            upper_zone = zone.split(".", 1)[1]
+            record = "dns-master-{}.{}".format(mtype, upper_zone)
+            self.logger.debug(
+                "Failed. Checking upper zone %s.", upper_zone)
+            answer = self._query(record, "TXT", deadline=deadline)
+
+        self.logger.debug("Got %s masters: %s.", mtype, answer)
+        return answer
+
+    def get_slaves(self, masters, deadline=None):
         zone = self.config["zone"]
-        self.logger.debug("Getting DNS slaves for zone {}.".format(zone))
-
-        slaves = dict()
-        for stype in masters.keys():
-            record = "dns-slave.{}".format(zone)
-            self.logger.debug("Looking for TXT record {} at {}.".format(
-                record, masters[stype]))
-            answer = self._query(
-                "dns-slave.{}".format(zone), "TXT", masters[stype])
-            slaves[stype] = answer
-
-        self.logger.debug("Slaves: {}.".format(slaves))
+        self.logger.debug("Getting DNS slaves for zone %s.", zone)
+
+        record = "dns-slave.{}".format(zone)
+        stypes = masters.keys()
+        for stype in stypes:
+            self.logger.debug("Looking for TXT record %s at %s.",
+                record, masters[stype])
+        answers = self.engine.run(
+            [ (self._query, [record, "TXT", masters[stype], deadline]) for stype in stypes ],
+            deadline)
+        slaves = dict(zip(stypes, answers))
+
+        self.logger.debug("Slaves: %s.", slaves)
         return slaves
 
-    def add_host(self, dnsserver, host, ip, ptr=False):
-        self._operate_record("add", dnsserver, host, "A", ip)
+    def probe_servers(self, servers, timeout, deadline=None):
+        """
+        Query zone SOA from every server in parallel.
+        Return [server, RTT] of alive servers, fastest first.
+        """
+        zone = self.config["zone"]
+        if deadline:
+            timeout = deadline.timeout(timeout)
+        rtts = dict()
+
+        def probe(server):
+            query = dns.message.make_query(zone, "SOA")
+            start = time.time()
+            try:
+                rcode = interact(
+                    "probe", "{} {}".format(server, zone),
+                    lambda: dns.query.udp(query, server, timeout=timeout).rcode())
+            except Exception as e:
+                self.logger.debug("Probe of %s failed: %s.", server, e)
+                return
+            if rcode == dns.rcode.NOERROR:
+                rtts[server] = time.time() - start
+            else:
+                self.logger.debug("Probe of %s failed: rcode=%s.", server, rcode)
+
+        threads = list()
+        for server in servers:
+            thread = threading.Thread(target=probe, args=(server,))
+            thread.daemon = True
+            thread.start()
+            threads.append(thread)
+        for thread in threads:
+            thread.join(timeout)
+
+        ranked = sorted(rtts.items(), key=lambda rtt: rtt[1])
+        self.logger.debug("Servers by RTT: %s.", ranked)
+        return [ list(rtt) for rtt in ranked ]
+
+    def get_serial(self, server, zone, deadline=None):
+        """Return serial of zone SOA at server"""
+        query = dns.message.make_query(zone, "SOA")
+        timeout = self._get_timeout(deadline)
+
+        def ask():
+            response = dns.query.udp(query, server, timeout=timeout)
+            for rrset in response.answer:
+                if rrset.rdtype == dns.rdatatype.SOA:
+                    return rrset[0].serial
+            return None
+
+        return interact("serial", "{} {}".format(server, zone), ask)
+
+    def wait_for_serial(self, servers, zone, serial, interval, deadline):
+        """
+        Poll servers in parallel until they get zone with serial or
+        deadline expires. Return servers which got it.
+        """
+        synced = list()
+
+        def poll(server):
+            while True:
+                try:
+                    current = self.get_serial(server, zone, deadline)
+                    if current is not None and self._serial_reached(current, serial):
+                        synced.append(server)
+                        return
+                    self.logger.debug("Serial of %s at %s is %s, waiting for %s.",
+                        zone, server, current, serial)
+                except DeadlineExceeded:
+                    return
+                except Exception as e:
+                    self.logger.debug("Failed to get serial of %s from %s: %s.",
+                        zone, server, e)
+                if deadline.remaining() <= interval:
+                    return
+                time.sleep(interval)
+
+        threads = list()
+        for server in servers:
+            thread = threading.Thread(target=poll, args=(server,))
+            thread.daemon = True
+            thread.start()
+            threads.append(thread)
+        for thread in threads:
+            thread.join(deadline.remaining())
+        return list(synced)
+
+    def transfer_zone(self, master, snapshot=None, deadline=None):
+        """
+        Return snapshot of zone refreshed by IXFR from its serial,
+        or a new one made by AXFR.
+        """
+        if snapshot is None:
+            snapshot = ZoneSnapshot(self.config["zone"])
+
+        keyname = None
+        if self.keyring:
+            keyname = self.config["update_key"]["name"]
+
+        if snapshot.serial is not None:
+            self.logger.debug("Requesting IXFR of %s from %s since serial %s.",
+                snapshot.origin, master, snapshot.serial)
+            try:
+                messages = self._transfer(
+                    master, snapshot.origin, "IXFR", snapshot.serial, keyname, deadline)
+                snapshot.apply_transfer(messages, incremental=True)
+                return snapshot
+            except DeadlineExceeded:
+                raise
+            except Exception as e:
+                self.logger.warning("IXFR of %s failed, falling back to AXFR: %s.",
+                    snapshot.origin, e)
+
+        self.logger.debug("Requesting AXFR of %s from %s.", snapshot.origin, master)
+        messages = self._transfer(master, snapshot.origin, "AXFR", None, keyname, deadline)
+        snapshot.apply_transfer(messages)
+        return snapshot
+
+    def _transfer(self, master, origin, rdtype, serial, keyname, deadline=None):
+        """Return messages of zone transfer, kept as text by recorder"""
+        timeout = self._get_timeout(deadline)
+        lifetime = self._get_lifetime(deadline)
+        return interact(
+            "transfer", "{} {} {} {}".format(master, origin, rdtype, serial),
+            lambda: list(dns.query.xfr(
+                master, origin, rdtype=rdtype, serial=serial or 0,
+                timeout=timeout, lifetime=lifetime,
+                keyring=self.keyring, keyname=keyname,
+                keyalgorithm=self.key_algorithm, relativize=False)),
+            encode=lambda messages: [ message.to_text() for message in messages ],
+            decode=lambda stored: [ dns.message.from_text(text) for text in stored ])
+
+    def get_origin(self, rdname, rdtype, dnsserver, deadline=None):
+        """Return name of zone record belongs to in view of server"""
+        return str(self._split_name(rdname, rdtype, dnsserver, deadline)[1])
+
+    def find_reverse_zone(self, rdname, dnsserver, deadline=None):
+        """
+        Return owner and origin of zone of PTR record name as server sees it,
+        None if it isn't found. Owner differs from name under classless
+        delegation (RFC 2317), where name is a CNAME to the record in
+        delegated zone.
+        """
+        name = dns.name.from_text(str(rdname))
+        prefix = name.parent()
+        if (dnsserver, name) in self.delegated_names:
+            return tuple(self.delegated_names[(dnsserver, name)])
+        if (dnsserver, prefix) in self.reverse_zones:
+            return name, self.reverse_zones[(dnsserver, prefix)]
+
+        found = interact(
+            "zone", "{} {}".format(dnsserver, name),
+            lambda: self._find_zone(name, dnsserver, deadline),
+            encode=lambda found: found and [str(found[0]), str(found[1])],
+            decode=lambda stored: stored and (
+                dns.name.from_text(stored[0]), dns.name.from_text(stored[1])))
+        if not found:
+            # Not memoized, so it's looked up again next time
+            return None
+        owner, origin = found
+        self.logger.debug("Found reverse zone %s of %s at %s.", origin, owner, dnsserver)
+        if owner != name:
+            # Names of one prefix may be delegated differently, memoize every name
+            self.delegated_names[(dnsserver, name)] = [owner, origin]
+            self.classless_prefixes.add((dnsserver, prefix))
+            self.reverse_zones.pop((dnsserver, prefix), None)
+        elif not (dnsserver, prefix) in self.classless_prefixes:
+            self.reverse_zones[(dnsserver, prefix)] = origin
+        return owner, origin
+
+    def add_host(self, dnsserver, host, ip, ptr=False, deadline=None):
+        self._operate_record("add", dnsserver, host, "A", ip, deadline)
         if ptr:
-            self.add_ptr(dnsserver, host, ip)
+            self.add_ptr(dnsserver, host, ip, deadline)
 
-    def delete_host(self, dnsserver, host, ip, ptr=False):
-        self._operate_record("delete", dnsserver, host, "A", ip)
+    def delete_host(self, dnsserver, host, ip, ptr=False, deadline=None):
+        self._operate_record("delete", dnsserver, host, "A", ip, deadline)
         if ptr:
-            self.delete_ptr(dnsserver, host, ip)
+            self.delete_ptr(dnsserver, host, ip, deadline)
 
-    def update_host(self, dnsserver, host, ip, ptr=False):
-        self._operate_record("replace", dnsserver, host, "A", ip)
+    def update_host(self, dnsserver, host, ip, ptr=False, deadline=None):
+        self._operate_record("replace", dnsserver, host, "A", ip, deadline)
         if ptr:
-            self.update_ptr(dnsserver, host, ip)
+            self.update_ptr(dnsserver, host, ip, deadline)
 
-    def add_ptr(self, dnsserver, host, ip):
+    def add_ptr(self, dnsserver, host, ip, deadline=None):
         ptr_record = dns.reversename.from_address(ip)
-        self._operate_record("add", dnsserver, ptr_record, "PTR", self._ensure_fqdn(host))
+        self._operate_record("add", dnsserver, ptr_record, "PTR", self._ensure_fqdn(host), deadline)
 
-    def delete_ptr(self, dnsserver, host, ip):
+    def delete_ptr(self, dnsserver, host, ip, deadline=None):
         ptr_record = dns.reversename.from_address(ip)
-        self._operate_record("delete", dnsserver, ptr_record, "PTR", self._ensure_fqdn(host))
+        self._operate_record("delete", dnsserver, ptr_record, "PTR", self._ensure_fqdn(host), deadline)
 
-    def update_ptr(self, dnsserver, host, ip):
+    def update_ptr(self, dnsserver, host, ip, deadline=None):
         ptr_record = dns.reversename.from_address(ip)
-        self._operate_record("replace", dnsserver, ptr_record, "PTR", self._ensure_fqdn(host))
-
-    def add_alias(self, dnsserver, cname, hostname):
-        self._operate_record("add", dnsserver, cname, "CNAME", self._ensure_fqdn(hostname))
-
-    def delete_alias(self, dnsserver, cname, hostname):
-        self._operate_record("delete", dnsserver, cname, "CNAME", self._ensure_fqdn(hostname))
+        self._operate_record("replace", dnsserver, ptr_record, "PTR", self._ensure_fqdn(host), deadline)
+
+    def add_alias(self, dnsserver, cname, hostname, deadline=None):
+        self._operate_record("add", dnsserver, cname, "CNAME", self._ensure_fqdn(hostname), deadline)
+
+    def delete_alias(self, dnsserver, cname, hostname, deadline=None):
+        self._operate_record("delete", dnsserver, cname, "CNAME", self._ensure_fqdn(hostname), deadline)
+
+    def update_alias(self, dnsserver, cname, hostname, deadline=None):
+        self._operate_record("replace", dnsserver, cname, "CNAME", self._ensure_fqdn(hostname), deadline)
+
+    def update_records(self, dnsserver, records, deadline=None):
+        """Replace records sending one update per zone"""
+        self._operate_records("replace", dnsserver, records, deadline)
+
+    def delete_records(self, dnsserver, records, deadline=None):
+        """Delete records sending one update per zone"""
+        self._operate_records("delete", dnsserver, records, deadline)
+
+    def find_missing(self, dnsserver, records, deadline=None):
+        """
+        Return records under classless delegation server doesn't have.
+        Server ignores update of name which is a CNAME without an error, so
+        it's the way to notice it. Other records aren't queried.
+        """
+        missing = list()
+        for record in records:
+            rdname, rdtype, data = record[:3]
+            if not (dnsserver, dns.name.from_text(str(rdname))) in self.delegated_names:
+                continue
+            try:
+                found = self._query(rdname, rdtype, [dnsserver], deadline)
+            except (dns.resolver.NXDOMAIN, dns.resolver.NoAnswer):
+                found = list()
+            if not data in found:
+                missing.append(record)
+        return missing
+
+    def _operate_records(self, action, dnsserver, records, deadline=None):
+        if not action in ["add", "delete", "replace"]:
+            self.misc.die("{} with DNS record isn't supported".format(action))
+        self._check_key()
+        updates = OrderedDict()
+        for record in records:
+            # Record may carry its own TTL
+            rdname, rdtype, data = record[:3]
+            ttl = self.config["ttl"]
+            if len(record) > 3:
+                ttl = record[3]
+            self.logger.debug("Adding %s of '%s':'%s' record with data '%s' to batch.",
+                action, rdtype, rdname, data)
+            rdname, origin = self._split_name(rdname, rdtype, dnsserver, deadline)
+            if not str(origin) in updates:
+                updates[str(origin)] = dns.update.Update(
+                    origin,
+                    keyring=self.keyring,
+                    keyalgorithm=self.key_algorithm)
+            update = updates[str(origin)]
+            if action == "delete":
+                update.delete(rdname, rdtype, data.encode("utf-8"))
+            else:
+                getattr(update, action)(
+                    rdname, ttl, rdtype, data.encode("utf-8"))
 
-    def update_alias(self, dnsserver, cname, hostname):
-        self._operate_record("replace", dnsserver, cname, "CNAME", self._ensure_fqdn(hostname))
+        for origin, update in updates.iteritems():
+            self.logger.debug("Sending batch update of zone %s to %s.",
+                origin, dnsserver)
+            self._send_update(update, dnsserver, deadline)
 
-    def _operate_record(self, action, dnsserver, rdname, rdtype, data):
+    def _operate_record(self, action, dnsserver, rdname, rdtype, data, deadline=None):
         if not action in ["add", "delete", "replace"]:
             self.misc.die("{} with DNS record isn't supported".format(action))
-        if not self.keyring:
-            self.misc.die("Keyring for DNS action not found")
-        if not self.key_algorithm:
-            self.misc.die("Key algorithm for DNS action not specified")
-        self.logger.debug("Doing {} of '{}':'{}' record at {} with data '{}'.".format(
-            action, rdtype, rdname, dnsserver, data))
+        self._check_key()
+        self.logger.debug("Doing %s of '%s':'%s' record at %s with data '%s'.",
+            action, rdtype, rdname, dnsserver, data)
 
         # Adjusting variables
-        if rdtype == "PTR":
-            rdname, origin = str(rdname).split(".", 1)
-        else:
-            origin = dns.name.from_text(self.config["zone"])
-            rdname = dns.name.from_text(rdname) - origin
+        rdname, origin = self._split_name(rdname, rdtype, dnsserver, deadline)
         data = data.encode("utf-8")
 
         # Collecting arguments for DNS update
@@ -139,13 +388,136 @@ class DNSOps:
             keyalgorithm=self.key_algorithm)  
         eval('update.{}(rdname, *args)'.format(action))
 
-        result = dns.query.tcp(update, dnsserver, timeout=self.config["timeout"])
+        self._send_update(update, dnsserver, deadline)
+
+    def _check_key(self):
+        if not self.keyring:
+            self.misc.die("Keyring for DNS action not found")
+        if not self.key_algorithm:
+            self.misc.die("Key algorithm for DNS action not specified")
+
+    def _split_name(self, rdname, rdtype, dnsserver, deadline=None):
+        """Return record name relative to its zone and zone origin"""
+        if rdtype == "PTR":
+            found = self.find_reverse_zone(rdname, dnsserver, deadline)
+            if not found:
+                raise Exception("Reverse zone of {} not found at {}".format(rdname, dnsserver))
+            owner, origin = found
+            rdname = owner.relativize(origin)
+        else:
+            origin = dns.name.from_text(self.config["zone"])
+            rdname = dns.name.from_text(rdname) - origin
+        return rdname, origin
+
+    def _find_zone(self, name, dnsserver, deadline=None):
+        """
+        Return owner and origin of zone of name, following CNAME, or None.
+        Zone is looked up at server, so split-horizon views are respected.
+        Server puts SOA of enclosing zone to authority section, so usually
+        one query is enough; otherwise walk up name by name.
+        """
+        resolver = dns.resolver.Resolver()
+        resolver.nameservers = [dnsserver]
+        owner = name
+        candidate = name
+        while True:
+            resolver.lifetime = self._get_timeout(deadline)
+            try:
+                response = resolver.query(
+                    candidate, "SOA", raise_on_no_answer=False).response
+            except dns.resolver.NXDOMAIN as e:
+                response = e.kwargs.get("responses", dict()).get(candidate)
+            except dns.resolver.NoNameservers:
+                # Server refuses names out of its zones
+                response = None
+            except dns.exception.Timeout:
+                self.logger.error("Timeout reached while looking for zone of %s at %s.",
+                    name, dnsserver)
+                return None
+
+            if response is not None:
+                for rrset in response.answer:
+                    if rrset.rdtype == dns.rdatatype.CNAME and rrset.name == owner:
+                        owner = rrset[0].target
+                for rrset in response.answer + response.authority:
+                    if rrset.rdtype == dns.rdatatype.SOA:
+                        return owner, rrset.name
+            try:
+                candidate = candidate.parent()
+            except dns.name.NoParent:
+                self.logger.error("Zone of %s not found at %s.", name, dnsserver)
+                return None
+
+    def _send_update(self, update, dnsserver, deadline=None):
+        attempt = 0
+        while True:
+            self.limiter.acquire(deadline)
+            result = interact(
+                "update", "{} {}".format(dnsserver, update.origin),
+                lambda: self._send_message(update, dnsserver, deadline),
+                encode=lambda response: {"rcode": response.rcode(), "flags": response.flags},
+                decode=lambda stored: self._make_response(update, stored))
+
+            # Overloaded master answers SERVFAIL or REFUSED, slow down & retry
+            if (result.rcode() in [dns.rcode.SERVFAIL, dns.rcode.REFUSED]
+                and attempt < self.limiter.retries):
+                attempt += 1
+                self.limiter.throttled()
+                continue
+            break
 
         rcode = self._compile_rcode(result)
+        if rcode[0] == 0:
+            self.limiter.succeeded()
         if rcode[0] != 0:
             self.misc.die("DNS update failed: rcode={}; message='{}'".format(rcode[0], rcode[1]))
         else:
-            self.logger.debug("DNS update done: rcode={}; message='{}'.".format(rcode[0], rcode[1]))
+            self.logger.debug("DNS update done: rcode=%s; message='%s'.", rcode[0], rcode[1])
+
+    def _send_message(self, message, dnsserver, deadline=None):
+        """
+        Send message to DNS server by UDP if it fits into datagram,
+        falling back to TCP on truncation or when UDP fails.
+        """
+        transport = self.config["transport"]
+        protocol = transport["masters"].get(dnsserver, transport["protocol"])
+
+        if protocol != "tcp":
+            if message.edns >= 0:
+                max_size = message.payload
+            else:
+                max_size = 512
+            size = len(message.to_wire())
+
+            if protocol == "udp" or size <= max_size:
+                for attempt in range(transport["udp_retries"] + 1):
+                    timeout = transport["udp_timeout"]
+                    if deadline:
+                        timeout = deadline.timeout(timeout)
+                    try:
+                        response = dns.query.udp(message, dnsserver, timeout=timeout)
+                    except dns.exception.Timeout:
+                        self.logger.debug("UDP timeout talking to %s, attempt %s.",
+                            dnsserver, attempt + 1)
+                        continue
+                    if not response.flags & dns.flags.TC:
+                        return response
+                    self.logger.debug("UDP response from %s truncated.", dnsserver)
+                    break
+                self.logger.debug("Falling back to TCP for %s.", dnsserver)
+            else:
+                self.logger.debug(
+                    "Message of %s bytes doesn't fit into UDP (%s bytes), using TCP.",
+                        size, max_size)
+
+        return dns.query.tcp(message, dnsserver, timeout=self._get_timeout(deadline))
+
+    def _make_response(self, update, stored):
+        """Make response to update from recorded rcode and flags"""
+        response = dns.message.Message(update.id)
+        response.flags = stored["flags"]
+        response.set_rcode(stored["rcode"])
+        return response
 
     def _compile_rcode(self, message):
         text = str()
@@ -156,29 +528,55 @@ class DNSOps:
                 text = match.group(1)
         return [ code, text ]
 
-    def _query(self, name, rtype="A", nameservers=None):
+    def _query(self, name, rtype="A", nameservers=None, deadline=None):
+        # Whole query including retries to every nameserver
+        lifetime = self._get_timeout(deadline)
+        return interact(
+            "query", "{} {} {}".format(name, rtype, nameservers),
+            lambda: self._resolve(name, rtype, nameservers, lifetime))
+
+    def _resolve(self, name, rtype, nameservers, lifetime):
         result = list()
         resolver = dns.resolver.Resolver()
         if nameservers:
             resolver.nameservers = nameservers
+        resolver.lifetime = lifetime
 
         answers = list()
         try:
             answers = resolver.query(name, rtype)
         except dns.exception.Timeout:
             self.logger.error(
-                "Timeout reached while getting {} record {} from {}.".format(
-                    rtype, name, nameservers))
+                "Timeout reached while getting %s record %s from %s.",
+                    rtype, name, nameservers)
 
         for answer in answers:
             if rtype == "TXT":
                 for line in answer.strings:
                     line = line.replace('"', "")
                     result.extend(line.split(","))
+            elif rtype in ["PTR", "CNAME"]:
+                result.append(str(answer.target))
             else:
                 result.append(answer.address)
         return result
 
+    def _serial_reached(self, current, serial):
+        """Compare serials using serial number arithmetic (RFC 1982)"""
+        return (current - serial) % 2**32 < 2**31
+
+    def _get_lifetime(self, deadline):
+        """Return time whole zone transfer may take"""
+        if deadline:
+            return deadline.timeout()
+        return None
+
+    def _get_timeout(self, deadline):
+        """Return configured timeout or what's left of deadline if less"""
+        if deadline:
+            return deadline.timeout(self.config["timeout"])
+        return self.config["timeout"]
+
     def _ensure_fqdn(self, name):
         """Make a proper FQDN from name"""
         if name[-1:] != ".":
@@ -1,25 +1,34 @@
+import os
+import sys
 import logging
 import re
+import time
+import threading
 import dns.reversename
 
+from collections import OrderedDict
+
 from dnsops import DNSOps
 from route53 import Route53
 from dhclient import DHClient
+from journal import Journal
+from ttl import TTLPolicy
+from addresses import Addresses
+from engine import Engine
+from deadline import Deadline, DeadlineExceeded
+from recorder import Recorder
 from misc import Misc
         
 
 class Provider:
 
     @staticmethod
-    def _look_for_alias(hostname, zone, alias_dict):
+    def _look_for_alias(hostname, zone, alias_index):
         """Check if hostname match any alias"""
-        aliases_list = None
-        for host_re, aliases in alias_dict.iteritems():
-            match = re.match(host_re, hostname)
-            if match:
-                host = match.group(0)
-                aliases_list = [ alias + "." + zone for alias in aliases ]
-        return aliases_list
+        aliases = alias_index.lookup(hostname)
+        if aliases is None:
+            return None
+        return [ alias + "." + zone for alias in aliases ]
 
     @staticmethod
     def _ensure_fqdn(name):
@@ -29,110 +38,709 @@ class Provider:
         else:
             return name
 
+    @staticmethod
+    def _add_record(records, name, rtype, data):
+        """Add record to ordered dict of records keyed as journal does"""
+        record = [name, rtype, data]
+        records[Journal.record_key(name, rtype)] = record
+
+    @staticmethod
+    def _add_heartbeat(records, fqdn, published, interval, last=None):
+        """
+        Add TXT record marking name as owned by alive dnswatch.
+        Published heartbeat (from journal, or last one of this run without
+        it) is reused until it's older than interval. Return heartbeat.
+        """
+        record = published.get(Journal.record_key(fqdn, "TXT"))
+        heartbeat = last
+        if record:
+            heartbeat = max(heartbeat, Provider()._parse_heartbeat(record[2]))
+        now = int(time.time())
+        if heartbeat is None or now - heartbeat >= interval:
+            heartbeat = now
+        Provider()._add_record(
+            records, fqdn, "TXT", '"dnswatch heartbeat={}"'.format(heartbeat))
+        return heartbeat
+
+    @staticmethod
+    def _heartbeat_lost(published, fqdn, max_age):
+        """
+        Tell if published heartbeat is older than max_age, so sweeper
+        may have deleted records journal still has.
+        """
+        record = published.get(Journal.record_key(fqdn, "TXT"))
+        if not record:
+            return False
+        heartbeat = Provider()._parse_heartbeat(record[2])
+        return heartbeat is not None and time.time() - heartbeat > max_age
+
+    @staticmethod
+    def _parse_heartbeat(data):
+        """Return time of heartbeat from TXT record data"""
+        match = re.search("dnswatch heartbeat=(\d+)", data)
+        if match:
+            return int(match.group(1))
+        return None
+
+    @staticmethod
+    def _add_addresses(forward, reverse, addresses, hostname, zone, private_ip, public_ip):
+        """
+        Add A record of every secondary address to forward records and
+        PTR record pointing to it by reverse(ptr_name), unless it's None.
+        """
+        for ip in addresses.collect([private_ip, public_ip]):
+            name = Provider()._ensure_fqdn(
+                "{}.{}".format(addresses.get_name(hostname, ip), zone))
+            Provider()._add_record(forward, name, "A", ip)
+            if reverse:
+                ptr_name = str(dns.reversename.from_address(ip))
+                records = reverse(ptr_name)
+                if records is not None:
+                    Provider()._add_record(records, ptr_name, "PTR", name)
+
+    @staticmethod
+    def _provider_configs(config):
+        """
+        Return (name, config) of every DNS provider. Each of several
+        providers gets dnsupdate options compiled for it by Config.
+        """
+        providers = config["dnsupdate"]["provider"]
+        if not isinstance(providers, list):
+            return [(providers, config)]
+        provider_configs = list()
+        for name in providers:
+            provider_config = dict(config)
+            provider_config["dnsupdate"] = config["dnsupdate"]["providers"][name]
+            provider_configs.append((name, provider_config))
+        return provider_configs
+
+    @staticmethod
+    def _batches(records, size):
+        """Split list of records into batches of size"""
+        return [ records[start:start + size] for start in xrange(0, len(records), size) ]
+
+    @staticmethod
+    def _plan_changes(desired, published, intents, force=False):
+        """
+        Compare desired records with journal.
+        Return records to update and records to delete.
+        """
+        pending = set()
+        deletes = list()
+        for intent in intents:
+            key = Journal.record_key(intent["name"], intent["type"])
+            record = [intent["name"], intent["type"], intent["data"]]
+            if "ttl" in intent:
+                record.append(intent["ttl"])
+            if key in desired:
+                # Replay unfinished change by updating record again
+                pending.add(key)
+            elif not record in deletes:
+                # Roll back unfinished change of unwanted record
+                deletes.append(record)
+
+        for key, record in published.iteritems():
+            if not key in desired and not record in deletes:
+                deletes.append(record)
+
+        updates = [ record for key, record in desired.iteritems()
+                        if force or key in pending or published.get(key) != record ]
+        return updates, deletes
+
+    @staticmethod
+    def _clear_ready_file(ready_file):
+        if ready_file and os.path.isfile(ready_file):
+            os.remove(ready_file)
+
+    @staticmethod
+    def _write_ready_file(ready_file):
+        if ready_file:
+            with open(ready_file, "w") as rf:
+                rf.write("{}\n".format(int(time.time())))
+
+    @staticmethod
+    def _run_parallel(logger, tasks, timeout):
+        """
+        Run (name, function, args) tasks in threads.
+        Return names of tasks not finished in timeout seconds (None to wait).
+        """
+        def run_task(name, function, args):
+            try:
+                function(*args)
+            except Exception as e:
+                logger.error("Task '%s' failed: %s.", name, e)
+
+        if timeout is not None:
+            deadline = time.time() + timeout
+        threads = list()
+        for name, function, args in tasks:
+            thread = threading.Thread(
+                name=name, target=run_task, args=(name, function, args))
+            # Unfinished tasks must not block exit
+            thread.daemon = True
+            thread.start()
+            threads.append(thread)
+
+        unfinished = list()
+        for thread in threads:
+            if timeout is None:
+                thread.join()
+            else:
+                thread.join(max(0, deadline - time.time()))
+            if thread.is_alive():
+                unfinished.append(thread.name)
+        return unfinished
+
+
+class MultiProvider:
+    """
+    Publish records to several DNS providers or zones at once.
+
+    Every action is run for all providers in parallel, so it takes as long
+    as the slowest provider. Failure or timeout of one provider is logged
+    and doesn't stop the others: its initial configuration is retried by
+    next watches. Startup fails only if all providers fail. Ready file is
+    written only when records of all providers reached their slaves.
+    """
+
+    def __init__(self, providers, propagation_config):
+        self.logger = logging.getLogger("DNSWatch.MultiProvider")
+        self.misc = Misc(self.logger)
+        # List of (name, provider) pairs
+        self.providers = providers
+        self.ready_file = None
+        if propagation_config["wait"]:
+            self.ready_file = propagation_config["ready_file"]
+        self.ready = False
+        for name, provider in self.providers:
+            # Ready file is ours, providers only report readiness
+            if hasattr(provider, "ready_file"):
+                provider.ready_file = None
+        # Providers which still need initial configuration
+        self.pending = set()
+        # Providers still running task of previous call
+        self.busy = set()
+
+    def initial_config(self, deadline=None):
+        """To do on start"""
+        Provider()._clear_ready_file(self.ready_file)
+        self.ready = False
+        self.pending = self._fan_out(
+            [ (name, "initial_config") for name, provider in self.providers ], deadline)
+        if len(self.pending) == len(self.providers):
+            self.misc.die("Initial configuration failed at all DNS providers")
+        self._update_ready_file()
+
+    def reload_config(self, deadline=None):
+        """To do on reload"""
+        Provider()._clear_ready_file(self.ready_file)
+        self.ready = False
+        self.pending = self._fan_out(
+            [ (name, "reload_config") for name, provider in self.providers ], deadline)
+        if len(self.pending) == len(self.providers):
+            self.misc.die("Reload of configuration failed at all DNS providers")
+        self._update_ready_file()
+
+    def watch(self, deadline=None):
+        """Some periodic actions"""
+        actions = list()
+        for name, provider in self.providers:
+            if name in self.pending:
+                actions.append((name, "initial_config"))
+            else:
+                actions.append((name, "watch"))
+        failed = self._fan_out(actions, deadline)
+        # Watch failure doesn't require initial configuration again
+        self.pending = set(
+            name for name, action in actions if action == "initial_config" and name in failed)
+        self._update_ready_file()
+
+    def notify_sources(self):
+        """Return NOTIFY sources of all providers"""
+        sources = list()
+        for name, provider in self.providers:
+            sources.extend(provider.notify_sources())
+        return sources
+
+    def rediscover(self, zones):
+        """Make providers of notified zones do discovery on next watch"""
+        for name, provider in self.providers:
+            provider.rediscover(zones)
+
+    def cleanup(self, deadline):
+        """To do on shutdown"""
+        self._fan_out(
+            [ (name, "cleanup") for name, provider in self.providers
+                if not name in self.pending ], deadline)
+
+    def _update_ready_file(self):
+        """Write ready file once all providers are ready, remove it otherwise"""
+        if not self.ready_file:
+            return
+        # Providers without propagation check are ready once configured
+        ready = not self.pending and not [
+            name for name, provider in self.providers if not getattr(provider, "ready", True) ]
+        if ready == self.ready:
+            return
+        self.ready = ready
+        if ready:
+            self.logger.info("DNS records of all providers propagated, ready.")
+            Provider()._write_ready_file(self.ready_file)
+        else:
+            self.logger.warning("DNS records of some providers aren't propagated, not ready.")
+            Provider()._clear_ready_file(self.ready_file)
+
+    def _fan_out(self, actions, deadline=None):
+        """Run (provider name, action) pairs in parallel, return failed names"""
+        providers = dict(self.providers)
+        failed = set()
+
+        def run(name, action):
+            try:
+                getattr(providers[name], action)(deadline)
+            except:
+                failed.add(name)
+                raise
+            finally:
+                self.busy.discard(name)
+
+        tasks = list()
+        for name, action in actions:
+            if name in self.busy:
+                self.logger.warning("Provider %s is still busy, skipping %s.",
+                    name, action)
+                if action != "watch":
+                    failed.add(name)
+                continue
+            self.busy.add(name)
+            tasks.append(("{} {}".format(name, action), run, [name, action]))
+        timeout = None
+        if deadline:
+            timeout = deadline.remaining()
+        for task in Provider()._run_parallel(self.logger, tasks, timeout):
+            self.logger.warning("Task '%s' not finished in time.", task)
+            failed.add(task.split(" ", 1)[0])
+        return failed
+
 
 class BindProvider:
 
-    def __init__(self, config):
+    def __init__(self, config, journal):
         self.logger = logging.getLogger("DNSWatch.BindProvider")
         self.misc = Misc(self.logger)
         self.dhcl = DHClient()
-        self.dnso = DNSOps(config["dnsupdate"])
+        self.engine = Engine(config["engine"])
+        self.dnso = DNSOps(config["dnsupdate"], self.engine)
+        self.journal = journal
 
         self.zone = config["dnsupdate"]["zone"]
         self.fqdn = config["host"]["fqdn"]
         self.private_ip = config["host"]["private_ip"]
         self.public_ip = config["host"]["public_ip"]
-        self.alias_dict = config["dnsupdate"]["alias"]
+        self.primary = config["host"]["primary"]
+        self.hostname = config["host"]["hostname"]
+        self.addresses = Addresses(config["addresses"])
+        self.batch = config["dnsupdate"]["batch"]
+        self.alias_index = config["dnsupdate"]["alias_index"]
         self.aliases = None
-
-    def initial_config(self):
+        self.records = None
+        self.masters = None
+        self.resolver_config = config["resolver"]
+        self.slave_rtts = dict()
+        # Failed probes of slaves in a row
+        self.slave_failures = dict()
+        self.propagation_config = config["propagation"]
+        self.ready_file = self.propagation_config["ready_file"]
+        self.ready = False
+        self.updated_masters = dict()
+        self.notify_config = config["notify"]
+        self.next_discovery = 0
+        self.heartbeat_config = config["heartbeat"]
+        # Heartbeats published by this run, journal may be disabled
+        self.heartbeats = dict()
+        # Records are republished after downtime sweeper may have noticed
+        self.heartbeat_max_age = min(
+            config["sweeper"]["max_age"], 2 * self.heartbeat_config["interval"])
+        self.ttl_policy = TTLPolicy(
+            config["dnsupdate"]["adaptive_ttl"], config["dnsupdate"]["ttl"])
+
+    def initial_config(self, deadline=None, force=False):
         """To do on start"""
-        self._initial_config_wo_resolvers()
+        self._initial_config_wo_resolvers(deadline, force)
 
+        # Local resolver is configured by provider of main zone
+        if not self.primary:
+            return
         if len(self.slaves["private"]) > 0:
-            self._setup_resolver(
-                self.slaves["private"], [self.zone])
+            slaves = self._rank_slaves(self.slaves["private"], deadline)
+            current_slaves = self._get_current_slaves()
+            # Don't reorder resolvers for nothing on every restart
+            if current_slaves and not self._slaves_changed(current_slaves, slaves):
+                slaves = current_slaves
+            self._setup_resolver(slaves, [self.zone])
         else:
             self.misc.die("No private DNS slaves found: {}.".format(self.slaves))
 
-    def reload_config(self):
+    def reload_config(self, deadline=None):
         """To do on reload"""
-        self._initial_config_wo_resolvers()
+        self._initial_config_wo_resolvers(deadline)
 
-    def _initial_config_wo_resolvers(self):
+    def _initial_config_wo_resolvers(self, deadline=None, force=False):
         self.dnso.setup_key()
 
-        self.masters = self.dnso.get_masters()
-        self.aliases = Provider()._look_for_alias(self.fqdn, self.zone, self.alias_dict)
-
-        if not self._update_records(self.masters['private'], self.private_ip, ptr=True):
+        self.masters = self.dnso.get_masters(deadline)
+        self._schedule_discovery()
+        self.aliases = Provider()._look_for_alias(self.fqdn, self.zone, self.alias_index)
+        self.records = self._compile_records()
+        self.updated_masters = dict()
+        self.ready = False
+        Provider()._clear_ready_file(self.ready_file)
+        force = force or self._records_lost()
+
+        updated = self.engine.run([
+            (self._update_records, ["private", self.masters['private'], deadline, force]),
+            (self._update_records, ["public", self.masters['public'], deadline, force])],
+            deadline)
+        if not updated[0]:
             self.misc.die("DNS update of PRIVATE view failed on all masters: {}".format(self.masters['private']))
-        if not self._update_records(self.masters['public'],self.public_ip, ptr=False):
+        if not updated[1]:
             self.misc.die("DNS update of PUBLIC view failed on all masters: {}".format(self.masters['public']))
 
-        self.slaves = self.dnso.get_slaves(self.masters)
+        self.slaves = self.dnso.get_slaves(self.masters, deadline)
+        self._verify_propagation(deadline)
 
-    def watch(self):
+    def watch(self, deadline=None):
         """Some periodic actions"""
+        if time.time() < self.next_discovery:
+            # Masters and slaves are discovered again on NOTIFY
+            self._refresh_records(deadline)
+            return
+        self._schedule_discovery()
+
     	# Check if masters changed
-        new_masters = self.dnso.get_masters()
+        new_masters = self.dnso.get_masters(deadline)
         if (self._list_changed(self.masters["private"], new_masters["private"])
             or self._list_changed(self.masters["public"], new_masters["public"])):
             self.logger.warning("Masters list changed.")
-            self.initial_config()
-        else:
+            # New masters may know nothing about us, so publish everything
+            self.initial_config(deadline, force=True)
+        elif self.primary:
             # Check if slaves list was changed
-            new_slaves = self.dnso.get_slaves(self.masters)
+            new_slaves = self.dnso.get_slaves(self.masters, deadline)
             if len(new_slaves["private"]) > 0:
-                old_slaves = self.dhcl.get_nameserver()
-                if self._list_changed(old_slaves, new_slaves["private"]):
+                old_slaves = self._get_current_slaves()
+                slaves = self._rank_slaves(new_slaves["private"], deadline)
+                if self._slaves_changed(old_slaves, slaves):
                     self.logger.warning("Slaves list changed.")
                     self.slaves = dict(new_slaves)
-                    self._setup_resolver(self.slaves["private"], [self.zone])
+                    self._setup_resolver(slaves, [self.zone])
             else:
-                self.logger.error("No private DNS slaves found: {}.".format(new_slaves))
+                self.logger.error("No private DNS slaves found: %s.", new_slaves)
 
-    def cleanup(self):
+            self._refresh_records(deadline)
+        else:
+            self._refresh_records(deadline)
+
+    def notify_sources(self):
+        """Return (zone, keyring, key name, masters) to accept NOTIFY of"""
+        if not self.dnso.keyring or not self.masters:
+            return list()
+        keyname = self.dnso.config["update_key"]["name"]
+        masters = self.masters["private"] + self.masters["public"]
+        # Masters are looked up in upper zone when zone has none
+        return [ (zone, self.dnso.keyring, keyname, masters)
+                    for zone in [self.zone, self.zone.split(".", 1)[-1]] ]
+
+    def rediscover(self, zones):
+        """Do discovery on next watch if any of zones is ours"""
+        ours = [ Provider()._ensure_fqdn(zone)
+                    for zone in [self.zone, self.zone.split(".", 1)[-1]] ]
+        if [ zone for zone in zones if Provider()._ensure_fqdn(zone) in ours ]:
+            self.next_discovery = 0
+
+    def _schedule_discovery(self):
+        if self.notify_config["enabled"]:
+            self.next_discovery = time.time() + self.notify_config["poll"]
+        else:
+            self.next_discovery = 0
+
+    def cleanup(self, deadline):
         """To do on shutdown"""
-        # Delete aliases if any
+        tasks = [ ("{} view".format(view), self._cleanup_view, [view, deadline])
+                    for view in ["private", "public"] ]
+        for task in Provider()._run_parallel(self.logger, tasks, deadline.remaining()):
+            self.logger.warning(
+                "Cleanup of %s not finished in %s seconds, left for retry "\
+                    "on next start.", task, deadline.budget)
+
+    def _cleanup_view(self, view, deadline):
+        zone = self._journal_zone(view)
+        # Delete aliases first, then hosts' records
+        records = list(reversed(self.records[view].values()))
+        # Registered deletes not committed in time are retried on next start
+        self.journal.begin_batch("bind", zone, "delete", records)
+        self.dnso.delete_records(self.masters[view][0], records, deadline)
+        self.journal.commit_batch("bind", zone, "delete", records)
+
+    def _compile_records(self):
+        """Make records this host should have in every view"""
+        fqdn = Provider()._ensure_fqdn(self.fqdn)
+        records = {"private": OrderedDict(), "public": OrderedDict()}
+
+        Provider()._add_record(records["private"], fqdn, "A", self.private_ip)
+        # IP has one PTR record, pointing to name in main zone
+        if self.primary:
+            Provider()._add_record(
+                records["private"],
+                str(dns.reversename.from_address(self.private_ip)), "PTR", fqdn)
+
+        # Secondary addresses are private, bind finds their reverse zones itself
+        reverse = None
+        if self.primary:
+            reverse = lambda ptr_name: records["private"]
+        Provider()._add_addresses(
+            records["private"], reverse, self.addresses, self.hostname, self.zone,
+            self.private_ip, self.public_ip)
+        Provider()._add_record(records["public"], fqdn, "A", self.public_ip)
+
+        # Add aliases if any
         if self.aliases:
             for alias in self.aliases:
-                self.dnso.delete_alias(self.masters["private"][0], alias, self.fqdn)
-                self.dnso.delete_alias(self.masters["public"][0], alias, self.fqdn)
-
-        # Delete hosts' records
-        self.dnso.delete_host(
-            self.masters["private"][0], self.fqdn, self.private_ip, ptr=True)
-        self.dnso.delete_host(
-            self.masters["public"][0], self.fqdn, self.public_ip)
+                alias = Provider()._ensure_fqdn(alias)
+                for view in ["private", "public"]:
+                    Provider()._add_record(records[view], alias, "CNAME", fqdn)
+
+        for view in ["private", "public"]:
+            zone = self._journal_zone(view)
+            published = self.journal.get_published("bind", zone)
+            # Mark our records as owned by alive host for sweeper
+            if self.heartbeat_config["enabled"]:
+                self.heartbeats[view] = Provider()._add_heartbeat(
+                    records[view], fqdn, published, self.heartbeat_config["interval"],
+                    self.heartbeats.get(view))
+            self.ttl_policy.apply(records[view], published, self.journal.get_since("bind", zone))
+        return records
+
+    def _refresh_records(self, deadline=None):
+        """
+        Republish records when heartbeat gets old, TTL steps up or
+        secondary addresses change
+        """
+        if (not self.heartbeat_config["enabled"] and not self.ttl_policy.enabled
+                and not self.addresses.enabled):
+            return
+        records = self._compile_records()
+        if records == self.records:
+            return
+        self.logger.debug("Refreshing records.")
+        self.records = records
+        views = ["private", "public"]
+        force = self._records_lost()
+        updated = self.engine.run(
+            [ (self._update_records, [view, self.masters[view], deadline, force])
+                for view in views ],
+            deadline)
+        for view, view_updated in zip(views, updated):
+            if not view_updated:
+                self.logger.error("Failed to refresh records in %s view.", view)
+
+    def _journal_zone(self, view):
+        return "{}/{}".format(self.zone, view)
+
+    def _records_lost(self):
+        """Tell if journaled records may be swept, so they need full republish"""
+        if not self.heartbeat_config["enabled"]:
+            return False
+        fqdn = Provider()._ensure_fqdn(self.fqdn)
+        for view in ["private", "public"]:
+            published = self.journal.get_published("bind", self._journal_zone(view))
+            if Provider()._heartbeat_lost(published, fqdn, self.heartbeat_max_age):
+                self.logger.warning(
+                    "Heartbeat in %s view is older than %s seconds, republishing "\
+                        "all records.", view, self.heartbeat_max_age)
+                return True
+        return False
 
-    def _update_records(self, masters, ip, ptr):
+    def _update_records(self, view, masters, deadline=None, force=False):
         """Try update on any master"""
+        zone = self._journal_zone(view)
+        updates, deletes = Provider()._plan_changes(
+            self.records[view],
+            self.journal.get_published("bind", zone),
+            self.journal.get_intents("bind", zone),
+            force)
+
+        if not updates and not deletes:
+            self.logger.info(
+                "Records of %s view are up to date, skipping update.", view)
+            return True
+
         for master in masters:
-            self.logger.debug("Trying update at master: {}.".format(master))
+            self.logger.debug("Trying update at master: %s.", master)
             try:
-                self.dnso.update_host(master, self.fqdn, ip, ptr=ptr)
-
-                # Add aliases if any
-                if self.aliases:
-                    for alias in self.aliases:
-                        self.dnso.update_alias(master, alias, self.fqdn)
+                self._operate_records(master, zone, "delete", deletes, deadline)
+                self._operate_records(master, zone, "replace", updates, deadline)
+                self.updated_masters[view] = master
                 return True
+            except DeadlineExceeded:
+                raise
             except:
+                self.logger.warning("Update at master %s failed: %s.",
+                    master, sys.exc_info()[1])
                 continue
         return False
 
+    def _operate_records(self, master, zone, action, records, deadline=None):
+        """Make changes in batches (one update per zone) registering them in journal"""
+        for batch in Provider()._batches(records, self.batch):
+            self.journal.begin_batch("bind", zone, action, batch)
+            if action == "delete":
+                self.dnso.delete_records(master, batch, deadline)
+                self.journal.commit_batch("bind", zone, action, batch)
+                continue
+
+            self.dnso.update_records(master, batch, deadline)
+            # PTR may land at CNAME of classless delegation, check it's there
+            missing = self.dnso.find_missing(master, batch, deadline)
+            self.journal.commit_batch(
+                "bind", zone, action, [ record for record in batch if not record in missing ])
+            if missing:
+                raise Exception("Master {} ignored update of {}".format(
+                    master, ", ".join(record[0] for record in missing)))
+
+    def _verify_propagation(self, deadline=None):
+        """Wait until slaves get serials of zones updated at masters"""
+        if not self.propagation_config["wait"]:
+            return
+
+        budget = self.propagation_config["timeout"]
+        if deadline:
+            budget = min(budget, deadline.remaining())
+        wait_deadline = Deadline("propagation", budget)
+
+        ready = True
+        for view, master in self.updated_masters.iteritems():
+            origins = list()
+            for record in self.records[view].values():
+                try:
+                    origin = self.dnso.get_origin(record[0], record[1], master, wait_deadline)
+                except DeadlineExceeded:
+                    raise
+                except Exception as e:
+                    self.logger.error("Failed to find zone of %s: %s.", record[0], e)
+                    ready = False
+                    continue
+                if not origin in origins:
+                    origins.append(origin)
+
+            for origin in origins:
+                serial = None
+                try:
+                    serial = self.dnso.get_serial(master, origin, wait_deadline)
+                    synced = self.dnso.wait_for_serial(
+                        self.slaves[view], origin, serial,
+                        self.propagation_config["interval"], wait_deadline)
+                except DeadlineExceeded:
+                    synced = list()
+                except Exception as e:
+                    self.logger.error("Failed to get serial of %s from %s: %s.",
+                        origin, master, e)
+                    ready = False
+                    continue
+
+                lagging = [ slave for slave in self.slaves[view] if not slave in synced ]
+                if lagging:
+                    self.logger.warning(
+                        "Zone %s (%s view) serial %s hasn't reached slaves in %s "\
+                            "seconds: %s.", origin, view, serial, budget, lagging)
+                    ready = False
+                else:
+                    self.logger.info("Zone %s (%s view) serial %s reached all slaves.",
+                        origin, view, serial)
+
+        if ready:
+            self.logger.info("DNS records propagated, ready.")
+            self.ready = True
+            Provider()._write_ready_file(self.ready_file)
+
+    def _rank_slaves(self, slaves, deadline=None):
+        """
+        Order slaves by RTT. Unresponsive ones go last instead of being
+        dropped, so a lost probe doesn't change the list of slaves.
+        """
+        if not self.resolver_config["probe"]:
+            return list(slaves)
+
+        ranked = self.dnso.probe_servers(
+            slaves, self.resolver_config["probe_timeout"], deadline)
+        if not ranked:
+            self.logger.warning(
+                "No DNS slave answered probe, keeping them as is: %s.", slaves)
+            self.slave_rtts = dict()
+            return list(slaves)
+
+        self.slave_rtts = dict(ranked)
+        alive = [ server for server, rtt in ranked ]
+        unresponsive = [ server for server in slaves if not server in alive ]
+        self.slave_failures = dict(
+            (server, self.slave_failures.get(server, 0) + 1) for server in unresponsive)
+        dead = [ server for server in unresponsive
+                    if self.slave_failures[server] >= self.resolver_config["max_failures"] ]
+        if dead:
+            self.logger.warning("DNS slaves don't answer probes: %s.", dead)
+        return alive + unresponsive
+
+    def _slaves_changed(self, old_slaves, new_slaves):
+        """
+        Tell if resolver needs new slaves: list of slaves changed, the first
+        slave in use stopped answering or the fastest slave is materially
+        faster than it.
+        """
+        if not self.resolver_config["probe"]:
+            return self._list_changed(old_slaves, new_slaves)
+        if set(old_slaves) != set(new_slaves):
+            return True
+        if old_slaves[0] == new_slaves[0]:
+            return False
+
+        old_rtt = self.slave_rtts.get(old_slaves[0])
+        new_rtt = self.slave_rtts.get(new_slaves[0])
+        if new_rtt is None:
+            return False
+        if old_rtt is None:
+            # Single lost probe isn't a reason to reconfigure resolver
+            return (self.slave_failures.get(old_slaves[0], 0)
+                    >= self.resolver_config["max_failures"])
+        gain = old_rtt - new_rtt
+        self.logger.debug("Slave %s is faster than %s by %.1f ms.",
+            new_slaves[0], old_slaves[0], gain * 1000)
+        return (gain * 1000 >= self.resolver_config["min_gain"]
+                and gain >= old_rtt * self.resolver_config["gain_ratio"])
+
+    def _get_current_slaves(self):
+        """Return nameservers dhclient configured with"""
+        try:
+            return self.dhcl.get_nameserver()
+        except TypeError:
+            # No such option in config yet
+            return list()
+
     def _setup_resolver(self, servers, domain):
+        if Recorder.replaying():
+            self.logger.info(
+                "Replaying, local resolver isn't configured with: NS=%s; domain=%s.",
+                    servers, domain)
+            return
         self.logger.info(
-            "Configuring local resolver with: NS={}; domain={}.".format(
-                servers, domain))
+            "Configuring local resolver with: NS=%s; domain=%s.",
+                servers, domain)
         self.dhcl.set_nameserver(servers)
         self.dhcl.set_search(domain)
         if self.dhcl.config_updated:
             self.dhcl.renew_lease()
 
     def _list_changed(self, first, second):
-        self.logger.debug("Comparing lists: {} vs {}.".format(first, second))
+        self.logger.debug("Comparing lists: %s vs %s.", first, second)
         if len(first) != len(second):
             return True
         else:
@@ -144,27 +752,42 @@ class BindProvider:
 
 class Route53Provider:
 
-    def __init__(self, config):
+    def __init__(self, config, journal):
         self.logger = logging.getLogger("DNSWatch.Route53Provider")
+        self.misc = Misc(self.logger)
 
         self.route = Route53(config["dnsupdate"], sync=False)
+        self.engine = Engine(config["engine"])
+        self.journal = journal
 
         self.zone = config["dnsupdate"]["zone"]
         self.fqdn = config["host"]["fqdn"]
         self.private_ip = config["host"]["private_ip"]
         self.public_ip = config["host"]["public_ip"]
-        self.alias_dict = config["dnsupdate"]["alias"]
+        self.primary = config["host"]["primary"]
+        self.hostname = config["host"]["hostname"]
+        self.addresses = Addresses(config["addresses"])
+        self.batch = config["dnsupdate"]["batch"]
+        self.alias_index = config["dnsupdate"]["alias_index"]
         self.aliases = None
-
-    def initial_config(self):
+        self.records = None
+        self.heartbeat_config = config["heartbeat"]
+        # Heartbeats published by this run, journal may be disabled
+        self.heartbeats = dict()
+        # Records are republished after downtime sweeper may have noticed
+        self.heartbeat_max_age = min(
+            config["sweeper"]["max_age"], 2 * self.heartbeat_config["interval"])
+        self.ttl_policy = TTLPolicy(
+            config["dnsupdate"]["adaptive_ttl"], config["dnsupdate"]["ttl"])
+
+    def initial_config(self, deadline=None):
         """To do on start"""
-        zones = self.route.get_zones()
+        zones = self.route.get_zones(deadline)
 
         zone = Provider()._ensure_fqdn(self.zone)
 
-        # Compile PTR record for private IP and PTR zone name
+        # Compile PTR record for private IP
         self.ptr_name = str(dns.reversename.from_address(self.private_ip))
-        ptr_zone_name = self.ptr_name.split(".", 1)[-1]
 
         # Find IDs for zones
         for zone_id, zone_info in zones.iteritems():
@@ -173,40 +796,182 @@ class Route53Provider:
                     self.private_zone_id = zone_id
                 else:
                     self.public_zone_id = zone_id
-            elif zone_info["Name"] == ptr_zone_name:
-                    self.private_ptr_zone_id = zone_id
-        
-        # Update zones
-        self.route.update_host(self.private_zone_id, self.fqdn, self.private_ip)
-        self.route.update_host(self.public_zone_id, self.fqdn, self.public_ip)
-        self.route.update_ptr(self.private_ptr_zone_id, self.ptr_name, self.fqdn)
-
-        self.aliases = Provider()._look_for_alias(self.fqdn, self.zone, self.alias_dict)
-
-        # Add aliases if any
-        if self.aliases:
-            for alias in self.aliases:
-                self.route.update_alias(self.private_zone_id, alias, self.fqdn)
-                self.route.update_alias(self.public_zone_id, alias, self.fqdn)
-
-    def reload_config(self):
+        # IP has one PTR record, pointing to name in main zone
+        self.private_ptr_zone_id = None
+        if self.primary:
+            self.private_ptr_zone_id = self.route.find_ptr_zone_id(self.ptr_name)
+            if not self.private_ptr_zone_id:
+                self.misc.die("Reverse zone of {} not found".format(self.ptr_name))
+
+        self.aliases = Provider()._look_for_alias(self.fqdn, self.zone, self.alias_index)
+        self.records = self._compile_records()
+        self._update_zones(deadline)
+
+    def _update_zones(self, deadline=None):
+        force = self._records_lost()
+        self.engine.run(
+            [ (self._update_zone, [zone_id, deadline, force])
+                for zone_id in self.records.keys() ],
+            deadline)
+
+    def _update_zone(self, zone_id, deadline=None, force=False):
+        updates, deletes = Provider()._plan_changes(
+            self.records[zone_id],
+            self.journal.get_published("route53", zone_id),
+            self.journal.get_intents("route53", zone_id),
+            force)
+        if not updates and not deletes:
+            self.logger.info(
+                "Records of zone %s are up to date, skipping update.",
+                    zone_id)
+        self._operate_records(zone_id, "delete", deletes, deadline)
+        self._operate_records(zone_id, "upsert", updates, deadline)
+
+    def reload_config(self, deadline=None):
         """To do on reload"""
-        self.initial_config()
+        self.initial_config(deadline)
 
-    def watch(self):
+    def watch(self, deadline=None):
         """Some periodic actions"""
         # Check if all request got 'SYNCED' status
-        self.route.check_request_status()
-
-    def cleanup(self):
+        self.route.check_request_status(deadline=deadline)
+
+        # Republish records when heartbeat gets old, TTL steps up or
+        # secondary addresses change
+        if (self.heartbeat_config["enabled"] or self.ttl_policy.enabled
+                or self.addresses.enabled):
+            records = self._compile_records()
+            if records != self.records:
+                self.logger.debug("Refreshing records.")
+                self.records = records
+                self._update_zones(deadline)
+
+    def notify_sources(self):
+        """Route53 sends no NOTIFY"""
+        return list()
+
+    def rediscover(self, zones):
+        """Route53 has nothing to discover"""
+        pass
+
+    def cleanup(self, deadline):
         """To do on shutdown"""
-        # Delete aliases if any
+        tasks = [ ("zone {}".format(zone_id), self._cleanup_zone, [zone_id, deadline])
+                    for zone_id in self.records.keys() ]
+        for task in Provider()._run_parallel(self.logger, tasks, deadline.remaining()):
+            self.logger.warning(
+                "Cleanup of %s not finished in %s seconds, left for retry "\
+                    "on next start.", task, deadline.budget)
+
+    def _cleanup_zone(self, zone_id, deadline):
+        # Route53 deletes only record with the same TTL, use journaled one
+        published = self.journal.get_published("route53", zone_id)
+        # Delete aliases first, then hosts' records
+        records = [ published.get(key, record)
+                        for key, record in reversed(self.records[zone_id].items()) ]
+        if not records:
+            # Route53 rejects change batch without changes
+            return
+        # Registered deletes not committed in time are retried on next start
+        self.journal.begin_batch("route53", zone_id, "delete", records)
+        self.route.delete_records(zone_id, records, deadline)
+        self.journal.commit_batch("route53", zone_id, "delete", records)
+
+    def _compile_records(self):
+        """Make records this host should have in every zone"""
+        fqdn = Provider()._ensure_fqdn(self.fqdn)
+        records = OrderedDict()
+        for zone_id in [self.private_zone_id, self.public_zone_id,
+                            self.private_ptr_zone_id]:
+            if zone_id:
+                records[zone_id] = OrderedDict()
+
+        Provider()._add_record(
+            records[self.private_zone_id], fqdn, "A", self.private_ip)
+        Provider()._add_record(
+            records[self.public_zone_id], fqdn, "A", self.public_ip)
+        if self.private_ptr_zone_id:
+            Provider()._add_record(
+                records[self.private_ptr_zone_id], self.ptr_name, "PTR", fqdn)
+
+        # Secondary addresses are private, their PTRs go to reverse zones found
+        reverse = None
+        if self.primary:
+            reverse = lambda ptr_name: self._reverse_records(records, ptr_name)
+        Provider()._add_addresses(
+            records[self.private_zone_id], reverse, self.addresses, self.hostname,
+            self.zone, self.private_ip, self.public_ip)
+        # Reverse zones which lost all addresses still need deletes, so do
+        # the ones journaled before restart
+        zone_ids = (self.records or dict()).keys()
+        if self.primary:
+            zone_ids.extend(self._journaled_reverse_zones())
+        for zone_id in zone_ids:
+            records.setdefault(zone_id, OrderedDict())
+
+        # Add aliases if any
         if self.aliases:
             for alias in self.aliases:
-                self.route.delete_alias(self.private_zone_id, alias, self.fqdn)
-                self.route.delete_alias(self.public_zone_id, alias, self.fqdn)
-        
-        # Delete hosts' records
-        self.route.delete_host(self.private_zone_id, self.fqdn, self.private_ip)
-        self.route.delete_host(self.public_zone_id, self.fqdn, self.public_ip)
-        self.route.delete_ptr(self.private_ptr_zone_id, self.ptr_name, self.fqdn)
+                alias = Provider()._ensure_fqdn(alias)
+                for zone_id in [self.private_zone_id, self.public_zone_id]:
+                    Provider()._add_record(records[zone_id], alias, "CNAME", fqdn)
+
+        # Mark our records as owned by alive host for sweeper
+        if self.heartbeat_config["enabled"]:
+            for zone_id in [self.private_zone_id, self.public_zone_id]:
+                self.heartbeats[zone_id] = Provider()._add_heartbeat(
+                    records[zone_id], fqdn,
+                    self.journal.get_published("route53", zone_id),
+                    self.heartbeat_config["interval"], self.heartbeats.get(zone_id))
+
+        for zone_id in records.keys():
+            self.ttl_policy.apply(
+                records[zone_id],
+                self.journal.get_published("route53", zone_id),
+                self.journal.get_since("route53", zone_id))
+        return records
+
+    def _records_lost(self):
+        """Tell if journaled records may be swept, so they need full republish"""
+        if not self.heartbeat_config["enabled"]:
+            return False
+        fqdn = Provider()._ensure_fqdn(self.fqdn)
+        for zone_id in [self.private_zone_id, self.public_zone_id]:
+            published = self.journal.get_published("route53", zone_id)
+            if Provider()._heartbeat_lost(published, fqdn, self.heartbeat_max_age):
+                self.logger.warning(
+                    "Heartbeat in zone %s is older than %s seconds, republishing "\
+                        "all records.", zone_id, self.heartbeat_max_age)
+                return True
+        return False
+
+    def _journaled_reverse_zones(self):
+        """Return zones journal has only PTR records and changes of"""
+        zone_ids = list()
+        for zone_id in self.journal.get_zones("route53"):
+            rtypes = set(record[1] for record in
+                            self.journal.get_published("route53", zone_id).values())
+            rtypes.update(intent["type"] for intent in
+                            self.journal.get_intents("route53", zone_id))
+            if rtypes == set(["PTR"]):
+                zone_ids.append(zone_id)
+        return zone_ids
+
+    def _reverse_records(self, records, ptr_name):
+        """Return records of reverse zone of PTR, None if there is no such zone"""
+        zone_id = self.route.find_ptr_zone_id(ptr_name)
+        if not zone_id:
+            self.logger.warning("Reverse zone of %s not found, skipping it.", ptr_name)
+            return None
+        return records.setdefault(zone_id, OrderedDict())
+
+    def _operate_records(self, zone_id, action, records, deadline=None):
+        """Make changes in batches (one change batch each) registering them in journal"""
+        # Route53 deletes only record with the same TTL, records carry it
+        for batch in Provider()._batches(records, self.batch):
+            self.journal.begin_batch("route53", zone_id, action, batch)
+            if action == "delete":
+                self.route.delete_records(zone_id, batch, deadline)
+            else:
+                self.route.update_records(zone_id, batch, deadline)
+            self.journal.commit_batch("route53", zone_id, action, batch)
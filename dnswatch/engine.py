@@ -0,0 +1,62 @@
+import threading
+import logging
+
+from deadline import DeadlineExceeded
+
+
+class Engine:
+    """
+    Runner of independent steps of one cycle (startup, reload, watch tick).
+
+    Serial engine runs steps one by one. Concurrent engine runs them in
+    threads, so a cycle takes about as long as its slowest step instead
+    of the sum of all of them.
+    """
+
+    MODES = ["serial", "concurrent"]
+
+    def __init__(self, mode="serial"):
+        self.logger = logging.getLogger("DNSWatch.Engine")
+        if not mode in self.MODES:
+            raise Exception("Engine mode {} isn't supported".format(mode))
+        self.mode = mode
+
+    def run(self, steps, deadline=None):
+        """
+        Run (function, args) steps, return their results in the same order.
+        First failed step's exception is raised after all steps finish.
+        """
+        if self.mode == "serial" or len(steps) < 2:
+            return [ function(*args) for function, args in steps ]
+
+        results = [None] * len(steps)
+        errors = [None] * len(steps)
+
+        def run_step(index, function, args):
+            try:
+                results[index] = function(*args)
+            except Exception as e:
+                errors[index] = e
+
+        threads = list()
+        for index, (function, args) in enumerate(steps):
+            thread = threading.Thread(target=run_step, args=(index, function, args))
+            # Step stuck after deadline must not block exit
+            thread.daemon = True
+            thread.start()
+            threads.append(thread)
+
+        for thread in threads:
+            if deadline:
+                thread.join(deadline.remaining())
+            else:
+                thread.join()
+            if thread.is_alive():
+                raise DeadlineExceeded(
+                    "Deadline of {} phase ({} seconds) exceeded".format(
+                        deadline.phase, deadline.budget))
+
+        for error in errors:
+            if error is not None:
+                raise error
+        return results
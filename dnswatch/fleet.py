@@ -0,0 +1,223 @@
+import sys
+import json
+import logging
+import threading
+import Queue
+import dns.reversename
+
+from collections import OrderedDict
+from dnsops import DNSOps
+from route53 import Route53
+from dnsproviders import Provider
+from deadline import Deadline
+from misc import Misc
+
+
+class Fleet:
+    """
+    Register records of many hosts read from inventory stream.
+
+    Inventory has one host per line, either as "host ip [alias,...]" or as
+    JSON object {"host": ..., "ip": ..., "aliases": [...]}. Hosts are sent
+    in batches (one DNS UPDATE or ChangeBatch per zone and provider) by a
+    bounded number of workers, so memory doesn't depend on inventory size.
+    """
+
+    def __init__(self, config):
+        self.logger = logging.getLogger("DNSWatch.Fleet")
+        self.misc = Misc(self.logger)
+        self.config = config
+        self.fleet_config = config["fleet"]
+        self.zone = config["dnsupdate"]["zone"]
+        self.ok = 0
+        self.failed = 0
+        self.lock = threading.Lock()
+
+        # Every host is registered at all providers
+        self.dnso = dict()
+        self.masters = dict()
+        self.route = dict()
+        self.alias_index = dict()
+        self.providers = list()
+        for name, provider_config in Provider()._provider_configs(config):
+            if name == "bind":
+                self.dnso[name] = DNSOps(provider_config["dnsupdate"])
+                self.dnso[name].setup_key()
+                self.masters[name] = self.dnso[name].get_masters()[self.fleet_config["view"]]
+            elif name == "route53":
+                self.route[name] = Route53(provider_config["dnsupdate"], sync=False)
+                self.route[name].get_zones()
+            else:
+                self.misc.die("DNS provider {} isn't supported".format(name))
+            self.alias_index[name] = provider_config["dnsupdate"]["alias_index"]
+            self.providers.append(name)
+
+    def register(self, inventory):
+        """Register all hosts from inventory file ('-' for stdin)"""
+        self.logger.info("Registering hosts from %s.", inventory)
+        batches = Queue.Queue(maxsize=self.fleet_config["workers"])
+
+        workers = list()
+        for i in range(self.fleet_config["workers"]):
+            worker = threading.Thread(target=self._worker, args=(batches,))
+            worker.daemon = True
+            worker.start()
+            workers.append(worker)
+
+        if inventory == "-":
+            stream = sys.stdin
+        else:
+            stream = open(inventory, "r")
+        try:
+            batch = list()
+            for entry in self._read_inventory(stream):
+                batch.append(entry)
+                if len(batch) >= self.fleet_config["batch"]:
+                    batches.put(batch)
+                    batch = list()
+            if batch:
+                batches.put(batch)
+        finally:
+            if stream is not sys.stdin:
+                stream.close()
+
+        for worker in workers:
+            batches.put(None)
+        for worker in workers:
+            worker.join()
+
+        self.logger.info("Registration finished: %s hosts succeeded, %s failed.",
+            self.ok, self.failed)
+        return self.failed == 0
+
+    def _read_inventory(self, stream):
+        """Yield inventory entries one by one"""
+        for number, line in enumerate(stream, 1):
+            line = line.strip()
+            if not line or line.startswith("#"):
+                continue
+            try:
+                if line.startswith("{"):
+                    entry = json.loads(line)
+                    host = entry["host"]
+                    ip = entry["ip"]
+                    aliases = entry.get("aliases", list())
+                else:
+                    fields = line.split()
+                    host = fields[0]
+                    ip = fields[1]
+                    aliases = list()
+                    if len(fields) > 2:
+                        aliases = fields[2].split(",")
+            except (ValueError, KeyError, IndexError) as e:
+                self._report(line, None, "failed: malformed inventory line {}: {}".format(
+                    number, e))
+                continue
+            yield {"host": self._make_fqdn(host), "ip": ip, "aliases": aliases}
+
+    def _worker(self, batches):
+        while True:
+            batch = batches.get()
+            if batch is None:
+                return
+            self._register_batch(batch)
+
+    def _register_batch(self, batch):
+        """Send records of batch grouped by zone"""
+        deadline = Deadline("fleet", self.fleet_config["timeout"])
+        zones = OrderedDict()
+        members = dict()
+        compiled = list()
+        for index, entry in enumerate(batch):
+            try:
+                pairs = self._compile_records(entry, deadline)
+            except Exception as e:
+                self._report(entry["host"], entry["ip"], "failed: {}".format(e))
+                continue
+            compiled.append(index)
+            for zone, record in pairs:
+                zones.setdefault(zone, list()).append(record)
+                members.setdefault(zone, set()).add(index)
+
+        failed = dict()
+        for zone, records in zones.iteritems():
+            try:
+                self._send(zone, records, deadline)
+            except Exception as e:
+                self.logger.error("Batch update of zone %s at %s failed: %s.",
+                    zone[1], zone[0], e)
+                for index in members[zone]:
+                    failed.setdefault(index, e)
+
+        for index in compiled:
+            entry = batch[index]
+            if index in failed:
+                self._report(entry["host"], entry["ip"], "failed: {}".format(failed[index]))
+            else:
+                self._report(entry["host"], entry["ip"], "ok")
+
+    def _compile_records(self, entry, deadline=None):
+        """Return ((provider, zone), record) pairs of entry"""
+        fqdn = Provider()._ensure_fqdn(entry["host"])
+        # Single foreign name would fail update of whole batch
+        if not fqdn.endswith(".{}.".format(self.zone.rstrip("."))):
+            self.misc.die("Host {} is out of zone {}".format(fqdn, self.zone))
+        ptr_name = str(dns.reversename.from_address(entry["ip"]))
+
+        pairs = list()
+        for provider in self.providers:
+            aliases = [ "{}.{}".format(alias, self.zone) for alias in entry["aliases"] ]
+            aliases.extend(Provider()._look_for_alias(
+                entry["host"], self.zone, self.alias_index[provider]) or list())
+
+            if provider == "bind":
+                zone = self.zone
+            else:
+                zone = self.route[provider].get_zone_id(
+                    Provider()._ensure_fqdn(self.zone), self.fleet_config["view"] == "private")
+
+            pairs.append(((provider, zone), [fqdn, "A", entry["ip"]]))
+            if self.fleet_config["ptr"]:
+                pairs.append(((provider, self._find_ptr_zone(provider, ptr_name, deadline)),
+                    [ptr_name, "PTR", fqdn]))
+            for alias in aliases:
+                pairs.append(((provider, zone), [Provider()._ensure_fqdn(alias), "CNAME", fqdn]))
+        return pairs
+
+    def _find_ptr_zone(self, provider, ptr_name, deadline=None):
+        if provider == "bind":
+            return self.dnso[provider].get_origin(
+                ptr_name, "PTR", self.masters[provider][0], deadline)
+        ptr_zone = self.route[provider].find_ptr_zone_id(ptr_name)
+        if not ptr_zone:
+            self.misc.die("Reverse zone of {} not found".format(ptr_name))
+        return ptr_zone
+
+    def _send(self, zone, records, deadline):
+        provider, zone = zone
+        if provider == "bind":
+            masters = self.masters[provider]
+            for master in masters:
+                try:
+                    self.dnso[provider].update_records(master, records, deadline)
+                    return
+                except Exception as e:
+                    self.logger.debug("Update at master %s failed: %s.", master, e)
+            self.misc.die("DNS update failed on all masters: {}".format(masters))
+        else:
+            self.route[provider].update_records(zone, records, deadline)
+
+    def _make_fqdn(self, host):
+        """Put short host names into zone"""
+        if host.endswith(".") or host.endswith(".{}".format(self.zone)):
+            return host.rstrip(".")
+        return "{}.{}".format(host, self.zone)
+
+    def _report(self, host, ip, result):
+        with self.lock:
+            if result == "ok":
+                self.ok += 1
+            else:
+                self.failed += 1
+            sys.stdout.write("{} {} {}\n".format(host, ip, result))
+            sys.stdout.flush()
@@ -13,11 +13,11 @@ class GCE:
             }
         self.cloud = Cloud(metadata)
 
-    def is_inside(self):
-        return self.cloud.is_inside()
+    def is_inside(self, deadline=None):
+        return self.cloud.is_inside(deadline)
 
-    def get_private_ip(self):
-        return self.cloud.get_data("network-interfaces/0/ip").text
+    def get_private_ip(self, deadline=None):
+        return self.cloud.get_data("network-interfaces/0/ip", deadline).text
 
-    def get_public_ip(self):
-        return self.cloud.get_data("network-interfaces/0/access-configs/0/external-ip").text
+    def get_public_ip(self, deadline=None):
+        return self.cloud.get_data("network-interfaces/0/access-configs/0/external-ip", deadline).text
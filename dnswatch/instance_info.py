@@ -2,14 +2,18 @@ import socket
 import fcntl
 import struct
 import logging
+import dns.resolver
 
 from gce import GCE
 from aws import AWS
+from deadline import DeadlineExceeded
+from recorder import interact, observe
 
 class InstanceInfo:
     def __init__(self, provider="other"):
         self.logger = logging.getLogger("DNSWatch.InstanceInfo")
         self.provider = provider
+        self.private_ip = None
         if provider == "gce":
             self.cloud = GCE()
         elif provider == "aws":
@@ -20,7 +24,7 @@ class InstanceInfo:
 
     def get_hostname(self):
         """Return only name before first dot."""
-        hostname = socket.gethostname()
+        hostname = observe("hostname", socket.gethostname)
         if hostname:
             try:
                 hostname = hostname.split(".")[0]
@@ -30,7 +34,7 @@ class InstanceInfo:
         else:
             return None
 
-    def get_private_ip(self):
+    def get_private_ip(self, deadline=None):
         """
         Return one IP address belongs to network interfaces used for
         external connections.
@@ -39,27 +43,46 @@ class InstanceInfo:
         ip = None
 
         if self.provider in ["aws", "gce"]:
-            ip = self._get_private_ip_cloud()
+            ip = self._get_private_ip_cloud(deadline)
         else:
-            ip = self._get_private_ip_other()
+            ip = observe("private_ip", lambda: self._get_private_ip_other(deadline))
 
-        self.logger.debug("My private IP: {}.".format(ip))
+        self.logger.debug("My private IP: %s.", ip)
+        self.private_ip = ip
         return ip
 
-    def get_public_ip(self):
+    def get_public_ip(self, deadline=None):
         self.logger.debug("Detecting public IP.")
         ip = None
 
         if self.provider in ["aws", "gce"]:
-            ip = self._get_public_ip_cloud()
+            ip = self._get_public_ip_cloud(deadline)
         else:
-            ip = self._get_public_ip_other()
+            ip = self._get_public_ip_other(deadline)
 
-        self.logger.debug("My public IP: {}.".format(ip))
+        self.logger.debug("My public IP: %s.", ip)
         return ip
 
-    def _get_private_ip_other(self):
+    def get_local_ips(self):
+        """Return IPv4 address of every interface having one"""
+        return observe("local_ips", self._get_local_ips)
+
+    def _get_local_ips(self):
         s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        local_ips = dict()
+        for interface in self._get_interfaces():
+            try:
+                local_ips[interface] = self._get_interface_ip(s, interface)
+            except IOError:
+                # Interface is down or has no IPv4 address
+                pass
+        s.close()
+        return local_ips
+
+    def _get_private_ip_other(self, deadline=None):
+        s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        if deadline:
+            s.settimeout(deadline.timeout())
         ip = None
 
         interfaces = self._get_interfaces()
@@ -75,29 +98,42 @@ class InstanceInfo:
             interface = interfaces[0]
 
             # Second method        
-            ip = socket.inet_ntoa(fcntl.ioctl(
-                s.fileno(),
-                0x8915,  # SIOCGIFADDR
-                struct.pack('256s', interface))[20:24])
+            ip = self._get_interface_ip(s, interface)
         s.close()
         return ip
 
-    def _get_private_ip_cloud(self):
-        return self.cloud.get_private_ip()
+    def _get_interface_ip(self, s, interface):
+        return socket.inet_ntoa(fcntl.ioctl(
+            s.fileno(),
+            0x8915,  # SIOCGIFADDR
+            struct.pack('256s', interface))[20:24])
+
+    def _get_private_ip_cloud(self, deadline=None):
+        return self.cloud.get_private_ip(deadline)
 
-    def _get_public_ip_other(self):
+    def _get_public_ip_other(self, deadline=None):
         ip = None
 
         try:
-            name = socket.gethostbyaddr(self.private_ip)[0]
-            ip = self._query(name, "A", ["8.8.8.8", "8.8.4.4"])[0]
-            #ip = self._query(name, "A", ["127.0.1.1"])[0]
+            # Private IP may be looked up at the same time by concurrent engine
+            private_ip = self.private_ip or observe(
+                "private_ip", lambda: self._get_private_ip_other(deadline))
+            name = interact("hostname", private_ip,
+                lambda: socket.gethostbyaddr(private_ip)[0])
+            resolver = dns.resolver.Resolver()
+            resolver.nameservers = ["8.8.8.8", "8.8.4.4"]
+            if deadline:
+                resolver.lifetime = deadline.timeout(resolver.lifetime)
+            ip = interact("resolve", "{} A".format(name),
+                lambda: resolver.query(name, "A")[0].address)
+        except DeadlineExceeded:
+            raise
         except:
             self.logger.error("Failed to find public IP.")
         return ip
 
-    def _get_public_ip_cloud(self):
-        return self.cloud.get_public_ip()
+    def _get_public_ip_cloud(self, deadline=None):
+        return self.cloud.get_public_ip(deadline)
 
     def _get_interfaces(self):
         self.logger.debug("Getting network interfaces.")
@@ -108,5 +144,5 @@ class InstanceInfo:
                 dev_name = dev.split(":")[0].strip()
                 if dev_name != "lo":
                     interfaces.append(dev_name)
-        self.logger.debug("Interfaces: {}.".format(interfaces))
+        self.logger.debug("Interfaces: %s.", interfaces)
         return interfaces
@@ -0,0 +1,161 @@
+import os
+import json
+import time
+import tempfile
+import threading
+import logging
+
+
+class Journal:
+    """
+    On-disk journal of published DNS records.
+
+    Records are kept per provider and zone as "name type" -> [name, type,
+    data, TTL]. Every change is registered as an intent before it is sent
+    and committed after it succeeds, so unfinished changes can be found
+    after a crash.
+    """
+
+    def __init__(self, config):
+        self.logger = logging.getLogger("DNSWatch.Journal")
+        self.enabled = config["enabled"]
+        self.journal_file = config["file"]
+        self.state = {"published": dict(), "intents": list(), "since": dict()}
+        # Turned off when journal file can't be written
+        self.writable = True
+        # Providers may clean several zones at once
+        self.lock = threading.Lock()
+
+        if self.enabled:
+            self._load()
+
+    def get_published(self, provider, zone):
+        """Return records published to zone by provider"""
+        return dict(self.state["published"].get(provider, {}).get(zone, {}))
+
+    def get_since(self, provider, zone):
+        """Return times records of zone got their current data"""
+        return dict(self.state["since"].get(provider, {}).get(zone, {}))
+
+    def get_zones(self, provider):
+        """Return zones provider has published records or unfinished changes in"""
+        zones = set(self.state["published"].get(provider, {}).keys())
+        zones.update(intent["zone"] for intent in self.state["intents"]
+                        if intent["provider"] == provider)
+        return sorted(zones)
+
+    def get_intents(self, provider, zone):
+        """Return unfinished changes of zone made by provider"""
+        return [ intent for intent in self.state["intents"]
+                    if intent["provider"] == provider and intent["zone"] == zone ]
+
+    def begin_batch(self, provider, zone, action, records):
+        """Register several changes of one zone before sending them"""
+        if not self.enabled:
+            return
+        with self.lock:
+            for record in records:
+                intent = self._compile_intent(provider, zone, action, record)
+                if not intent in self.state["intents"]:
+                    self.state["intents"].append(intent)
+            self._save()
+
+    def commit_batch(self, provider, zone, action, records):
+        """Mark several changes of one zone as done"""
+        if not self.enabled:
+            return
+        with self.lock:
+            zones = self.state["published"].setdefault(provider, dict())
+            published = zones.setdefault(zone, dict())
+            since = self.state["since"].setdefault(provider, dict()).setdefault(zone, dict())
+            now = int(time.time())
+            for record in records:
+                intent = self._compile_intent(provider, zone, action, record)
+                if intent in self.state["intents"]:
+                    self.state["intents"].remove(intent)
+
+                key = self.record_key(record[0], record[1])
+                old = published.get(key)
+                if action == "delete":
+                    if old and old[:3] == record[:3]:
+                        published.pop(key)
+                        since.pop(key, None)
+                else:
+                    # TTL change keeps record stable, data change doesn't
+                    if not old or old[:3] != record[:3] or not key in since:
+                        since[key] = now
+                    published[key] = list(record)
+            if not published:
+                zones.pop(zone)
+            if not since:
+                self.state["since"][provider].pop(zone)
+            self._save()
+
+    @staticmethod
+    def record_key(name, rtype):
+        return "{} {}".format(name, rtype)
+
+    def _compile_intent(self, provider, zone, action, record):
+        intent = {
+            "provider": provider,
+            "zone": zone,
+            "action": action,
+            "name": record[0],
+            "type": record[1],
+            "data": record[2]
+        }
+        if len(record) > 3:
+            intent["ttl"] = record[3]
+        return intent
+
+    def _load(self):
+        if not os.path.isfile(self.journal_file):
+            self.logger.debug("Journal %s not found, starting with empty one.",
+                self.journal_file)
+            return
+
+        self.logger.debug("Loading journal from %s.", self.journal_file)
+        try:
+            with open(self.journal_file, "r") as jf:
+                state = json.load(jf)
+            self.state["published"] = state["published"]
+            self.state["intents"] = state["intents"]
+            # Journals written before adaptive TTLs have no times
+            self.state["since"] = state.get("since", dict())
+        except (IOError, ValueError, KeyError) as e:
+            self.logger.warning(
+                "Failed to load journal %s, starting with empty one: %s.",
+                    self.journal_file, e)
+            return
+
+        if self.state["intents"]:
+            self.logger.warning("Journal has %s unfinished changes.",
+                len(self.state["intents"]))
+
+    def _save(self):
+        """Write journal atomically: temporary file + rename"""
+        if not self.writable:
+            return
+        journal_dir = os.path.dirname(self.journal_file)
+        try:
+            if journal_dir and not os.path.isdir(journal_dir):
+                os.makedirs(journal_dir)
+
+            fd, tmp_file = tempfile.mkstemp(
+                dir=journal_dir or ".", prefix=".journal-")
+            try:
+                with os.fdopen(fd, "w") as jf:
+                    json.dump(self.state, jf, indent=2, sort_keys=True)
+                    jf.flush()
+                    os.fsync(jf.fileno())
+                os.rename(tmp_file, self.journal_file)
+            except:
+                if os.path.exists(tmp_file):
+                    os.remove(tmp_file)
+                raise
+        except (IOError, OSError) as e:
+            # DNS updates matter more than journal, keep it in memory only
+            self.logger.warning(
+                "Failed to save journal %s, keeping it in memory for this run: %s.",
+                    self.journal_file, e)
+            self.writable = False
@@ -14,15 +14,15 @@ class Killer:
         signal.signal(signal.SIGUSR1, self.exit_wo_cleanup)
 
     def exit_gracefully(self, signum, frame):
-	self.logger.debug("Signal handler called with signal: {}.".format(signum))
+	self.logger.debug("Signal handler called with signal: %s.", signum)
         self.kill_now = True
         self.cleanup = True
 
     def reload_app(self, signum, frame):
-	self.logger.debug("Signal handler called with signal: {}.".format(signum))
+	self.logger.debug("Signal handler called with signal: %s.", signum)
         self.reload_now = True
 
     def exit_wo_cleanup(self, signum, frame):
-	self.logger.debug("Signal handler called with signal: {}.".format(signum))
+	self.logger.debug("Signal handler called with signal: %s.", signum)
         self.kill_now = True
         self.cleanup = False
@@ -0,0 +1,99 @@
+import os
+import stat
+import errno
+import logging
+
+
+HOOK = """# Installed by dnswatch: pass DHCP lease events to it, never block dhclient
+if [ -p "{fifo}" ]; then
+    timeout 2 sh -c 'echo "$1" > "$2"' dnswatch \\
+        "reason=$reason interface=$interface old_ip=$old_ip_address new_ip=$new_ip_address" \\
+        "{fifo}" >/dev/null 2>&1 &
+fi
+"""
+
+
+class LeaseEvents:
+    """
+    DHCP lease events sent by dhclient exit hook.
+
+    Hook writes a line per event into FIFO, so watch wakes up as soon as a
+    lease is bound, renewed or lost instead of noticing it on next poll.
+    FIFO is kept open for writing too, so it never reaches end of file
+    while hook has nothing to write.
+    """
+
+    def __init__(self, config):
+        self.logger = logging.getLogger("DNSWatch.LeaseEvents")
+        self.enabled = config["enabled"]
+        self.fifo = config["fifo"]
+        self.hook = config["hook"]
+        self.fd = None
+        self.buffer = ""
+
+        if self.enabled:
+            self._open_fifo()
+            self._install_hook()
+
+    def fileno(self):
+        return self.fd
+
+    def read(self):
+        """Return events received so far as dicts"""
+        try:
+            while True:
+                chunk = os.read(self.fd, 4096)
+                if not chunk:
+                    break
+                self.buffer += chunk
+        except OSError as e:
+            if e.errno != errno.EAGAIN:
+                raise
+
+        lines = self.buffer.split("\n")
+        self.buffer = lines.pop()
+        events = list()
+        for line in lines:
+            event = dict(
+                field.split("=", 1) for field in line.split() if "=" in field)
+            if event.get("reason"):
+                self.logger.info("DHCP lease event: %s.", line)
+                events.append(event)
+        return events
+
+    def close(self):
+        """Remove hook and FIFO, so dhclient doesn't talk to nobody"""
+        if not self.enabled:
+            return
+        for path in [self.hook, self.fifo]:
+            try:
+                os.remove(path)
+            except OSError as e:
+                if e.errno != errno.ENOENT:
+                    self.logger.warning("Failed to remove %s: %s.", path, e)
+        os.close(self.fd)
+        self.fd = None
+
+    def _open_fifo(self):
+        fifo_dir = os.path.dirname(self.fifo)
+        if fifo_dir and not os.path.isdir(fifo_dir):
+            os.makedirs(fifo_dir)
+        if os.path.exists(self.fifo) and not stat.S_ISFIFO(os.stat(self.fifo).st_mode):
+            os.remove(self.fifo)
+        if not os.path.exists(self.fifo):
+            os.mkfifo(self.fifo, 0o600)
+        self.fd = os.open(self.fifo, os.O_RDWR | os.O_NONBLOCK)
+        self.logger.debug("Listening to DHCP lease events on %s.", self.fifo)
+
+    def _install_hook(self):
+        hook = HOOK.format(fifo=self.fifo)
+        if os.path.isfile(self.hook):
+            with open(self.hook, "r") as hf:
+                if hf.read() == hook:
+                    return
+        hook_dir = os.path.dirname(self.hook)
+        if hook_dir and not os.path.isdir(hook_dir):
+            os.makedirs(hook_dir)
+        with open(self.hook, "w") as hf:
+            hf.write(hook)
+        self.logger.info("Installed dhclient exit hook %s.", self.hook)
@@ -0,0 +1,85 @@
+import logging
+import threading
+
+
+class RepeatFilter(logging.Filter):
+    """
+    Suppression of repeated identical log messages.
+
+    Message is let through once per window, its repeats within the window
+    are only counted. Next time it's let through, the count is appended to
+    it. So a persistent error logged every watch tick shows up once per
+    window with "repeated N times" instead of flooding the log. Repeats of
+    message which doesn't come again are summarized through handler when
+    their window expires and at shutdown.
+    """
+
+    SUMMARY = "%s (repeated %s times in %s seconds)"
+
+    def __init__(self, window, handler=None):
+        logging.Filter.__init__(self)
+        self.window = window
+        self.handler = handler
+        # (logger, level, message) -> [time let through, repeats, last repeat]
+        self.seen = dict()
+        self.pruned = 0
+        # Threads of engine and listeners log at the same time
+        self.lock = threading.Lock()
+
+    def filter(self, record):
+        if not self.window:
+            return True
+        key = (record.name, record.levelno, record.getMessage())
+        with self.lock:
+            entry = self.seen.get(key)
+            if entry and record.created - entry[0] < self.window:
+                entry[1] += 1
+                entry[2] = record
+                return False
+
+            if entry and entry[1]:
+                record.msg = self.SUMMARY
+                record.args = (key[2], entry[1], int(record.created - entry[0]))
+            self.seen[key] = [record.created, 0, None]
+            summaries = self._prune(record.created)
+        self._emit(summaries)
+        return True
+
+    def flush(self):
+        """Emit summaries of all pending repeats"""
+        with self.lock:
+            summaries = self._prune(None)
+        self._emit(summaries)
+
+    def _prune(self, now):
+        """
+        Forget messages which weren't repeated for a window, return summary
+        records of expired repeats. Everything is expired when now is None.
+        """
+        if now is not None and now - self.pruned < self.window:
+            return list()
+        if now is not None:
+            self.pruned = now
+
+        summaries = list()
+        for key, (since, repeats, last) in self.seen.items():
+            if now is not None and now - since < self.window:
+                continue
+            if repeats:
+                summary = logging.makeLogRecord(last.__dict__)
+                summary.msg = self.SUMMARY
+                summary.args = (key[2], repeats, int(last.created - since))
+                summaries.append(summary)
+            del self.seen[key]
+        return sorted(summaries, key=lambda summary: summary.created)
+
+    def _emit(self, summaries):
+        # Summaries don't go through filters again
+        if not self.handler:
+            return
+        for summary in summaries:
+            self.handler.acquire()
+            try:
+                self.handler.emit(summary)
+            finally:
+                self.handler.release()
@@ -3,21 +3,33 @@
 # dnswatch - tool for automatic DNS configuration
 ##############################################################################
 import os
+import atexit
 import sys
 import logging
 import argparse
 import traceback
 import socket
 import time
+import hashlib
 
 from core import DNSWatch
 from misc import Misc
 from config import Config
+from fleet import Fleet
+from sweeper import Sweeper
+from dnsproviders import Provider
+from memwatch import MemWatch
+from leaseevents import LeaseEvents
+from notify import NotifyListener
+from profiler import Profiler
+from recorder import Recorder, observe
+from deadline import Deadline
 from killer import Killer
+from logfilter import RepeatFilter
 
 from __init__ import __version__
 ##############################################################################
-def get_logger(name, log_level="DEBUG", log_file=None):
+def get_logger(name, log_level="DEBUG", log_file=None, log_repeat=0):
     logger = logging.getLogger(name)
     logger.setLevel(eval("logging.{}".format(log_level.upper())))
     if log_file:
@@ -30,6 +42,10 @@ def get_logger(name, log_level="DEBUG", log_file=None):
     formatter = logging.Formatter(
         '%(asctime)s %(process)-8d %(name)-22s %(levelname)-8s %(message)s')
     handler.setFormatter(formatter)
+    repeat_filter = RepeatFilter(log_repeat, handler)
+    handler.addFilter(repeat_filter)
+    # Runs before logging closes handlers at exit
+    atexit.register(repeat_filter.flush)
     logger.addHandler(handler)
     return logger
 
@@ -48,6 +64,35 @@ def _parse_argv():
                     metavar=['debug', 'info', 'warning', 'error', 'critical'], 
                     default='info',
                     help='Log level')
+    parser.add_argument('--log-repeat',
+                    metavar='SECONDS',
+                    type=int,
+                    default=300,
+                    help='Log repeated identical message once per period with '\
+                        'number of repeats, 0 to log every repeat')
+    parser.add_argument('-f', '--fleet',
+                    metavar='FILE',
+                    help='Register hosts from inventory file (- for stdin) and exit')
+    parser.add_argument('-s', '--sweep',
+                    action='store_true',
+                    help='Delete records of dead hosts and exit')
+    parser.add_argument('-p', '--profile',
+                    action='store_true',
+                    help='Profile startup, reload, cleanup and first watch ticks '\
+                        '(SIGUSR2 toggles at runtime)')
+    capture = parser.add_mutually_exclusive_group()
+    capture.add_argument('--record',
+                    metavar='FILE',
+                    help='Record network interactions with their latencies to file')
+    capture.add_argument('--replay',
+                    metavar='FILE',
+                    help='Replay network interactions recorded to file instead of '\
+                        'sending them')
+    parser.add_argument('--replay-speed',
+                    metavar='FACTOR',
+                    type=float,
+                    default=1.0,
+                    help='Multiply recorded latencies by factor on replay, 0 for none')
     parser.add_argument('-t', '--trace',
                     action='store_true',
                     help='Show python traceback')
@@ -74,42 +119,113 @@ def get_lock(name, timeout=60):
         except socket.error:
             return False
 
+def get_jitter(name, window):
+    """
+    Return delay within window derived from name, so every host of a fleet
+    gets its own but stable delay.
+    """
+    if not window:
+        return 0
+    digest = int(hashlib.md5(name).hexdigest(), 16)
+    return (digest % (int(window) * 1000)) / 1000.0
+
 ###############################################################################
 def main():
     killer = Killer()
 
     args = _parse_argv()
 
-    logger = get_logger("DNSWatch", log_level=args.loglevel, log_file=args.logfile)
-    logger.info("Starting dnswatch v.{}.".format(__version__))
+    logger = get_logger("DNSWatch", log_level=args.loglevel, log_file=args.logfile,
+        log_repeat=args.log_repeat)
+    logger.info("Starting dnswatch v.%s.", __version__)
 
     misc = Misc(logger)
 
     try: 
         exit_code = 2
 
+        if args.record:
+            Recorder.current = Recorder("record", args.record)
+        elif args.replay:
+            Recorder.current = Recorder("replay", args.replay, args.replay_speed)
+
+        if args.fleet:
+            # One-shot registration of many hosts, no lock and no watch
+            config = Config().read(args.config)
+            if Recorder.current:
+                Recorder.current.isolate(config)
+            if Fleet(config).register(args.fleet):
+                logger.info("Finished successfully.")
+                exit_code = 0
+            else:
+                logger.error("Registration of some hosts failed.")
+                exit_code = 1
+            return
+
+        if args.sweep:
+            # One-shot sweep, safe to run from cron on any host
+            config = Config().read(args.config)
+            if Recorder.current:
+                Recorder.current.isolate(config)
+            for name, provider_config in Provider()._provider_configs(config):
+                Sweeper(provider_config).sweep()
+            logger.info("Finished successfully.")
+            exit_code = 0
+            return
+
         if not get_lock("dnswatch", timeout=5):
             misc.die("Lock exists")
 
         c = Config()
         action = None
+        profiler = None
+        memwatch = None
+        lease_events = None
+        notify_listener = None
         while True:
             config = c.read(args.config)
-            dw = DNSWatch(config)
+            if Recorder.current:
+                Recorder.current.isolate(config)
+            if not profiler:
+                profiler = Profiler(config["profile"], args.profile)
+            if not memwatch:
+                memwatch = MemWatch(config["memory"])
+            if not lease_events:
+                lease_events = LeaseEvents(config["lease_events"])
+            if not notify_listener:
+                notify_listener = NotifyListener(config["notify"])
+
+            # Spread requests of a fleet started or reloaded at once
+            if action == 'reload':
+                jitter = get_jitter(observe("hostname", socket.gethostname),
+                    config["jitter"]["reload"])
+            else:
+                jitter = get_jitter(observe("hostname", socket.gethostname),
+                    config["jitter"]["startup"])
+            if jitter:
+                logger.info("Waiting %s seconds of jitter.", jitter)
+                time.sleep(jitter)
 
             if action == 'reload':
-                dw.reload_config()
+                deadline = Deadline("reload", config["deadline"]["reload"])
+                dw = profiler.run("init", DNSWatch, config, deadline, profiler, memwatch,
+                    lease_events, notify_listener)
+                profiler.run("reload_config", dw.reload_config, deadline)
             else:
-                dw.initial_config()
+                deadline = Deadline("startup", config["deadline"]["startup"])
+                dw = profiler.run("init", DNSWatch, config, deadline, profiler, memwatch,
+                    lease_events, notify_listener)
+                profiler.run("initial_config", dw.initial_config, deadline)
             
             try: 
-                action = dw.watch(pause=config["watch"]["pause"])
+                action = dw.watch(pause=config["watch"]["pause"], config_changed=c.changed)
             except: 
-                action = dw.watch()
+                action = dw.watch(config_changed=c.changed)
 
             if action == "kill":
                 # Do DNS cleanup and exit loop
-                dw.cleanup()
+                profiler.run(
+                    "cleanup", dw.cleanup, Deadline("cleanup", config["cleanup"]["timeout"]))
                 break
             elif action == "softkill":
                 # Exit loop without DNS cleanup
@@ -120,6 +236,8 @@ def main():
             else:
                 misc.die("Unknown action requested: {}".format(action))
 
+        lease_events.close()
+        notify_listener.close()
         logger.info("Finished successfully.")
         exit_code = 0
     except SystemExit:
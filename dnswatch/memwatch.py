@@ -0,0 +1,83 @@
+import gc
+import signal
+import logging
+import psutil
+
+from collections import Counter
+
+# tracemalloc isn't available on every Python, object counts are used without it
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+
+class MemWatch:
+    """
+    Opt-in memory instrumentation of the daemon.
+
+    Every watch tick logs RSS and number of objects tracked by gc. SIGWINCH
+    requests a snapshot which is taken on next tick and compared with the
+    previous one: by allocation site with tracemalloc, by object type
+    without it.
+    """
+
+    def __init__(self, config):
+        self.logger = logging.getLogger("DNSWatch.MemWatch")
+        self.enabled = config["enabled"]
+        self.top = config["top"]
+        self.process = psutil.Process()
+        self.snapshot = None
+        self.snapshot_requested = False
+
+        if not self.enabled:
+            return
+        if tracemalloc:
+            tracemalloc.start(config["frames"])
+            self.logger.info("Memory watch enabled, snapshots by allocation site.")
+        else:
+            self.logger.info("Memory watch enabled, snapshots by object type "\
+                "(tracemalloc isn't available).")
+        signal.signal(signal.SIGWINCH, self.request_snapshot)
+
+    def request_snapshot(self, signum=None, frame=None):
+        # Snapshot is heavy, don't take it inside signal handler
+        self.snapshot_requested = True
+
+    def tick(self):
+        """Log memory usage, take snapshot if requested"""
+        if not self.enabled:
+            return
+        rss = self.process.memory_info().rss
+        self.logger.info("Memory: RSS %.1f MiB, %s objects, gc counts %s.",
+            rss / 1048576.0, len(gc.get_objects()), gc.get_count())
+
+        if self.snapshot_requested:
+            self.snapshot_requested = False
+            self.take_snapshot()
+
+    def take_snapshot(self):
+        """Take snapshot and log top differences from previous one"""
+        if tracemalloc:
+            snapshot = tracemalloc.take_snapshot()
+            if self.snapshot:
+                for stat in snapshot.compare_to(self.snapshot, "lineno")[:self.top]:
+                    self.logger.info("Memory diff: %s.", stat)
+            else:
+                for stat in snapshot.statistics("lineno")[:self.top]:
+                    self.logger.info("Memory usage: %s.", stat)
+        else:
+            gc.collect()
+            snapshot = Counter(type(obj).__name__ for obj in gc.get_objects())
+            if self.snapshot:
+                diff = Counter(snapshot)
+                diff.subtract(self.snapshot)
+                growth = sorted(diff.items(), key=lambda item: -abs(item[1]))
+                for name, delta in growth[:self.top]:
+                    if delta:
+                        self.logger.info("Memory diff: %s %+d (total %s).",
+                            name, delta, snapshot[name])
+            else:
+                for name, count in snapshot.most_common(self.top):
+                    self.logger.info("Memory usage: %s %s.", name, count)
+        self.snapshot = snapshot
@@ -0,0 +1,109 @@
+import errno
+import socket
+import logging
+import dns.message
+import dns.opcode
+import dns.rdatatype
+import dns.name
+
+
+class NotifyListener:
+    """
+    Listener of DNS NOTIFY messages sent by masters on zone change.
+
+    NOTIFY is accepted only from known masters of zone, signed with TSIG
+    key of zone. Accepted NOTIFY is answered, so master stops resending it,
+    and its zone is returned to trigger discovery of masters and slaves.
+    """
+
+    def __init__(self, config):
+        self.logger = logging.getLogger("DNSWatch.NotifyListener")
+        self.enabled = config["enabled"]
+        self.sock = None
+        # Zone name -> list of {"keyname": ..., "masters": [...]}
+        self.zones = dict()
+        self.keyring = dict()
+
+        if not self.enabled:
+            return
+        try:
+            self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            self.sock.bind((config["address"], config["port"]))
+            self.sock.setblocking(False)
+        except socket.error as e:
+            # Discovery falls back to polling
+            self.logger.error("Failed to listen for NOTIFY on %s:%s: %s.",
+                config["address"], config["port"], e)
+            self.enabled = False
+            return
+        self.logger.info("Listening for NOTIFY on %s:%s.", config["address"], config["port"])
+
+    def fileno(self):
+        return self.sock.fileno()
+
+    def set_sources(self, sources):
+        """Set (zone, keyring, keyname, masters) NOTIFY is accepted for"""
+        self.zones = dict()
+        self.keyring = dict()
+        for zone, keyring, keyname, masters in sources:
+            if not keyring:
+                continue
+            self.keyring.update(keyring)
+            self.zones.setdefault(dns.name.from_text(zone), list()).append(
+                {"keyname": dns.name.from_text(keyname), "masters": masters})
+
+    def read(self):
+        """Return zones of valid NOTIFY messages received so far"""
+        zones = list()
+        while True:
+            try:
+                wire, source = self.sock.recvfrom(65535)
+            except socket.error as e:
+                if e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    break
+                raise
+            zone = self._check(wire, source)
+            if zone and not zone in zones:
+                zones.append(zone)
+        return zones
+
+    def close(self):
+        if self.sock:
+            self.sock.close()
+            self.sock = None
+
+    def _check(self, wire, source):
+        """Validate NOTIFY, answer it and return its zone"""
+        try:
+            message = dns.message.from_wire(wire, keyring=self.keyring)
+        except Exception as e:
+            self.logger.warning("Rejected message from %s: %s.", source[0], e)
+            return None
+
+        if message.opcode() != dns.opcode.NOTIFY or len(message.question) != 1:
+            self.logger.debug("Ignored non-NOTIFY message from %s.", source[0])
+            return None
+        question = message.question[0]
+        zones = self.zones.get(question.name)
+        if question.rdtype != dns.rdatatype.SOA or not zones:
+            self.logger.debug("Ignored NOTIFY of %s from %s.", question.name, source[0])
+            return None
+        zones = [ zone for zone in zones if source[0] in zone["masters"] ]
+        if not zones:
+            self.logger.warning(
+                "Rejected NOTIFY of %s from %s, it isn't a master.", question.name, source[0])
+            return None
+        if not message.had_tsig or not message.keyname in [ zone["keyname"] for zone in zones ]:
+            self.logger.warning(
+                "Rejected NOTIFY of %s from %s, it isn't signed with zone key.",
+                    question.name, source[0])
+            return None
+
+        response = dns.message.make_response(message)
+        try:
+            self.sock.sendto(response.to_wire(), source)
+        except socket.error as e:
+            self.logger.warning("Failed to answer NOTIFY from %s: %s.", source[0], e)
+        self.logger.info("Got NOTIFY of %s from %s.", question.name, source[0])
+        return question.name.to_text()
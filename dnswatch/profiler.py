@@ -0,0 +1,93 @@
+import os
+import glob
+import time
+import signal
+import logging
+import cProfile
+import pstats
+import StringIO
+
+
+class Profiler:
+    """
+    Optional cProfile capture of startup, reload, cleanup and watch ticks.
+
+    Every profiled call gets its pstats file and top-N text summary in
+    profile directory, only the newest files are kept. Watch ticks are
+    profiled up to configured number after enabling. SIGUSR2 toggles
+    profiling at runtime.
+    """
+
+    def __init__(self, config, enabled=False):
+        self.logger = logging.getLogger("DNSWatch.Profiler")
+        self.profile_dir = config["dir"]
+        self.keep = config["keep"]
+        self.top = config["top"]
+        self.sort = config["sort"]
+        self.ticks = config["ticks"]
+        self.enabled = False
+        self.ticks_left = 0
+
+        if enabled:
+            self.enable()
+        signal.signal(signal.SIGUSR2, self.toggle)
+
+    def enable(self):
+        self.enabled = True
+        self.ticks_left = self.ticks
+        self.logger.info("Profiling enabled, results go to %s.", self.profile_dir)
+
+    def disable(self):
+        self.enabled = False
+        self.logger.info("Profiling disabled.")
+
+    def toggle(self, signum=None, frame=None):
+        if self.enabled:
+            self.disable()
+        else:
+            self.enable()
+
+    def run(self, name, function, *args, **kwargs):
+        """Call function, profiling it if enabled"""
+        if not self.enabled:
+            return function(*args, **kwargs)
+        if name == "watch":
+            if self.ticks_left <= 0:
+                return function(*args, **kwargs)
+            self.ticks_left -= 1
+
+        profile = cProfile.Profile()
+        try:
+            return profile.runcall(function, *args, **kwargs)
+        finally:
+            try:
+                self._save(name, profile)
+            except (IOError, OSError) as e:
+                self.logger.error("Failed to save profile of %s: %s.", name, e)
+
+    def _save(self, name, profile):
+        if not os.path.isdir(self.profile_dir):
+            os.makedirs(self.profile_dir)
+        base = os.path.join(self.profile_dir, "{}-{}-{}".format(
+            name, time.strftime("%Y%m%d-%H%M%S"), os.getpid()))
+
+        profile.dump_stats("{}.pstats".format(base))
+
+        summary = StringIO.StringIO()
+        stats = pstats.Stats(profile, stream=summary)
+        stats.sort_stats(self.sort).print_stats(self.top)
+        with open("{}.txt".format(base), "w") as sf:
+            sf.write(summary.getvalue())
+        self.logger.info("Profile of %s saved to %s.pstats (%.3f seconds).",
+            name, base, stats.total_tt)
+
+        self._rotate()
+
+    def _rotate(self):
+        """Delete all but newest profiles"""
+        profiles = sorted(
+            glob.glob(os.path.join(self.profile_dir, "*.pstats")), key=os.path.getmtime)
+        for old in profiles[:-self.keep]:
+            for path in [old, "{}.txt".format(old[:-len(".pstats")])]:
+                if os.path.exists(path):
+                    os.remove(path)
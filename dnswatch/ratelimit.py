@@ -0,0 +1,81 @@
+import time
+import threading
+import logging
+
+
+# Limiters shared by all zones and reloads of process, per backend
+limiters = dict()
+limiters_lock = threading.Lock()
+
+
+def shared_limiter(backend, config):
+    """Return limiter of backend (bind, route53) configured by config"""
+    with limiters_lock:
+        limiter = limiters.get(backend)
+        if limiter is None:
+            limiter = limiters[backend] = RateLimiter(config)
+        else:
+            limiter.configure(config)
+    return limiter
+
+
+class RateLimiter:
+    """
+    Token bucket limiting rate of requests to DNS masters or Route53
+    with adaptive backoff when remote side reports overload.
+    """
+
+    def __init__(self, config):
+        self.logger = logging.getLogger("DNSWatch.RateLimiter")
+        self.lock = threading.Lock()
+        self.tokens = float(config["burst"])
+        self.updated = time.time()
+        self.backoff = 0
+        self.configure(config)
+
+    def configure(self, config):
+        """Apply limits of config keeping tokens and backoff learned so far"""
+        with self.lock:
+            self.rate = float(config["rate"])
+            self.burst = float(config["burst"])
+            self.retries = config["retries"]
+            self.min_backoff = float(config["backoff"])
+            self.max_backoff = float(config["max_backoff"])
+            self.tokens = min(self.tokens, self.burst)
+            self.backoff = min(self.backoff, self.max_backoff)
+
+    def acquire(self, deadline=None):
+        """Wait for a token and current backoff, but not past deadline"""
+        with self.lock:
+            now = time.time()
+            self.tokens = min(
+                self.burst, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+
+            # Take token in advance, so next callers queue after us
+            self.tokens -= 1
+            wait = self.backoff
+            if self.tokens < 0:
+                wait += -self.tokens / self.rate
+
+        if deadline:
+            wait = min(wait, deadline.remaining())
+        if wait > 0:
+            self.logger.debug("Rate limit reached, waiting %.2f seconds.", wait)
+            time.sleep(wait)
+
+    def throttled(self):
+        """Remote side asked to slow down: increase backoff"""
+        with self.lock:
+            self.backoff = min(
+                self.max_backoff, max(self.min_backoff, self.backoff * 2))
+        self.logger.warning("Request throttled, backoff is %.2f seconds now.",
+            self.backoff)
+
+    def succeeded(self):
+        """Request went fine: decrease backoff"""
+        with self.lock:
+            if self.backoff:
+                self.backoff /= 2
+                if self.backoff < self.min_backoff:
+                    self.backoff = 0
@@ -0,0 +1,217 @@
+import os
+import json
+import time
+import tempfile
+import threading
+import logging
+import requests
+import dns.resolver
+import dns.exception
+
+from subprocess import CalledProcessError
+from deadline import DeadlineExceeded
+
+
+class Recorder:
+    """
+    Capture of external interactions of a run and their replay.
+
+    In record mode every interaction (metadata request, DNS query, DNS
+    UPDATE, Route53 call) is appended to capture file with its latency,
+    result or error, so are facts of local host (hostname, addresses) and
+    state files the run starts from. In replay mode interactions aren't
+    sent anywhere: recorded results are returned in the same order per
+    interaction key after recorded latency multiplied by speed factor, and
+    the run starts from recorded state. Local side effects (state files,
+    resolver setup, ready file) are kept away from the replaying host.
+    """
+
+    # Sections of config with state file the run starts from
+    STATE_FILES = ["journal", "bootcache"]
+
+    # Recorder of current run, None when neither recording nor replaying
+    current = None
+
+    # Errors which are raised again on replay; others become plain Exception
+    ERRORS = [
+        dns.resolver.NXDOMAIN,
+        dns.resolver.NoAnswer,
+        dns.resolver.NoNameservers,
+        dns.exception.Timeout,
+        requests.exceptions.ConnectionError,
+        requests.exceptions.Timeout,
+        DeadlineExceeded,
+        IOError,
+        OSError,
+    ]
+
+    def __init__(self, mode, capture_file, speed=1.0):
+        self.logger = logging.getLogger("DNSWatch.Recorder")
+        self.mode = mode
+        self.capture_file = capture_file
+        self.speed = speed
+        self.lock = threading.Lock()
+        self.interactions = dict()
+        # Sections of state files recorded or seeded already
+        self.states = set()
+
+        if mode == "record":
+            self.capture = open(capture_file, "w")
+            self.logger.info("Recording interactions to %s.", capture_file)
+        elif mode == "replay":
+            self._load()
+            # State files of replayed run live here
+            self.state_dir = tempfile.mkdtemp(prefix="dnswatch-replay-")
+            self.logger.info("Replaying interactions from %s at speed factor %s.",
+                capture_file, speed)
+        else:
+            raise Exception("Recorder mode {} isn't supported".format(mode))
+
+    def interact(self, kind, key, function, encode=None, decode=None, sticky=False):
+        """
+        Do interaction (zero argument function) or replay it.
+        Result is stored as encode(result) and restored as decode(stored).
+        Last sticky interaction is replayed again when others are used up.
+        """
+        if self.mode == "replay":
+            return self._replay(kind, key, decode, sticky)
+
+        start = time.time()
+        entry = {"kind": kind, "key": key}
+        try:
+            result = function()
+        except Exception as e:
+            entry["error"] = self._error_name(e)
+            entry["message"] = str(e)
+            if hasattr(e, "response") and isinstance(e.response, dict):
+                # botocore ClientError
+                entry["response"] = e.response
+                entry["operation"] = getattr(e, "operation_name", None)
+            raise
+        else:
+            entry["result"] = encode(result) if encode else result
+            return result
+        finally:
+            entry["latency"] = time.time() - start
+            self._write(entry)
+
+    def isolate(self, config):
+        """
+        Record state files the run starts from, or keep replayed run from
+        changing host: seed state from capture, redirect it, drop side effects
+        """
+        if self.mode == "record":
+            for section in self.STATE_FILES:
+                if not section in self.states:
+                    self._record_state(section, config[section]["file"])
+            return
+
+        # Replay starts from recorded state, never from files of this host
+        for section in self.STATE_FILES:
+            state_file = os.path.join(self.state_dir, os.path.basename(config[section]["file"]))
+            if not section in self.states:
+                self._seed_state(section, state_file)
+            config[section]["file"] = state_file
+        config["sweeper"]["state_dir"] = os.path.join(self.state_dir, "sweeper")
+        config["propagation"]["ready_file"] = None
+        # Events from dhclient and masters can't be replayed
+        config["lease_events"]["enabled"] = False
+        config["notify"]["enabled"] = False
+
+    @staticmethod
+    def replaying():
+        """Tell if current run is replayed"""
+        return Recorder.current is not None and Recorder.current.mode == "replay"
+
+    def _record_state(self, section, state_file):
+        content = None
+        try:
+            if os.path.isfile(state_file):
+                with open(state_file, "r") as sf:
+                    content = sf.read()
+        except IOError as e:
+            self.logger.warning("Failed to record %s state %s: %s.", section, state_file, e)
+        self.states.add(section)
+        self._write({"kind": "state", "key": section, "result": content, "latency": 0})
+
+    def _seed_state(self, section, state_file):
+        self.states.add(section)
+        recorded = self.interactions.get(("state", section))
+        if not recorded or recorded[0]["result"] is None:
+            return
+        with open(state_file, "w") as sf:
+            sf.write(recorded[0]["result"].encode("utf-8"))
+
+    def _replay(self, kind, key, decode, sticky=False):
+        with self.lock:
+            queue = self.interactions.get((kind, key))
+            if not queue:
+                raise Exception("No recorded {} interaction for {}".format(kind, key))
+            if sticky and len(queue) == 1:
+                entry = queue[0]
+            else:
+                entry = queue.pop(0)
+
+        if self.speed:
+            time.sleep(entry["latency"] * self.speed)
+        if "error" in entry:
+            raise self._make_error(entry)
+        if decode:
+            return decode(entry["result"])
+        return entry["result"]
+
+    def _write(self, entry):
+        line = json.dumps(entry, default=str)
+        with self.lock:
+            self.capture.write(line + "\n")
+            self.capture.flush()
+
+    def _load(self):
+        with open(self.capture_file, "r") as cf:
+            for line in cf:
+                if not line.strip():
+                    continue
+                entry = json.loads(line)
+                self.interactions.setdefault(
+                    (entry["kind"], entry["key"]), list()).append(entry)
+        self.logger.debug("Loaded %s interaction keys.", len(self.interactions))
+
+    @staticmethod
+    def _error_name(error):
+        """Return error class name with module, same in package and out of it"""
+        if not isinstance(error, type):
+            error = type(error)
+        module = error.__module__
+        if module.startswith("dnswatch."):
+            module = module[len("dnswatch."):]
+        return "{}.{}".format(module, error.__name__)
+
+    def _make_error(self, entry):
+        name = entry["error"]
+        if "response" in entry:
+            # Route53 is optional, botocore is imported only when needed
+            import botocore.exceptions
+            return botocore.exceptions.ClientError(entry["response"], entry["operation"])
+        if name == self._error_name(CalledProcessError):
+            return CalledProcessError(1, entry["message"])
+        for error in self.ERRORS:
+            if self._error_name(error) == name:
+                return error(entry["message"])
+        return Exception("{}: {}".format(name, entry["message"]))
+
+
+def interact(kind, key, function, encode=None, decode=None):
+    """Do interaction through recorder of current run if any"""
+    if Recorder.current is None:
+        return function()
+    return Recorder.current.interact(kind, key, function, encode, decode)
+
+
+def observe(key, function):
+    """
+    Read fact of local host through recorder of current run if any.
+    Replay keeps returning the last recorded fact once others are used up.
+    """
+    if Recorder.current is None:
+        return function()
+    return Recorder.current.interact("host", key, function, sticky=True)
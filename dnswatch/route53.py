@@ -1,10 +1,18 @@
 import logging
 import boto3
+import botocore.config
+import botocore.exceptions
 
 from misc import Misc
+from ratelimit import shared_limiter
+from recorder import interact
 
 
 class Route53:
+    # Error codes AWS uses to ask for slowing down
+    THROTTLING_CODES = ["Throttling", "ThrottlingException", "PriorRequestNotComplete"]
+    # Seconds between checks of change status
+    WAITER_DELAY = 5
 
     def __init__(self, config, sync=True):
         self.logger = logging.getLogger("DNSWatch.Route53")
@@ -12,19 +20,25 @@ class Route53:
         self.config = config
         self.sync = sync
         self.unchecked_requests = list()
+        self.zone_index = dict()
+        self.zone_cache = dict()
+        self.limiter = shared_limiter("route53", config["ratelimit"])
         self.client = boto3.client(
                         "route53",
                         aws_access_key_id=config["update_key"]["name"],
-                        aws_secret_access_key=config["update_key"]["key"])
+                        aws_secret_access_key=config["update_key"]["key"],
+                        config=botocore.config.Config(
+                            connect_timeout=config["timeout"],
+                            read_timeout=config["timeout"]))
 
     def update_host(self, host, ip, ptr=False):
         result = True
         return result
 
-    def get_zones(self):
+    def get_zones(self, deadline=None):
         self.logger.debug("Getting hosted DNS zones.")
         zones = dict()
-        response = self.client.list_hosted_zones()
+        response = self._call("list_hosted_zones", deadline)
 
         if not response["IsTruncated"]:
             zones_info = response["HostedZones"]
@@ -37,79 +51,208 @@ class Route53:
                 "Name": zone["Name"],
                 "Private": zone["Config"]["PrivateZone"]
             }
+        self._index_zones(zones)
         return zones
 
-    def add_host(self, zone_id, hostname, ip, ptr=False):
-        self._operate_record("create", zone_id, hostname, "A", ip)
+    def find_zone_id(self, name, private=None):
+        """
+        Return ID of the deepest hosted zone name belongs to, or None.
+        Zone type isn't checked when private is None.
+        """
+        key = (name, private)
+        if key in self.zone_cache:
+            return self.zone_cache[key]
 
-    def delete_host(self, zone_id, hostname, ip, ptr=False):
-        self._operate_record("delete", zone_id, hostname, "A", ip)
+        labels = name.rstrip(".").split(".")
+        zone_id = None
+        for i in range(len(labels)):
+            suffix = "{}.".format(".".join(labels[i:]))
+            for candidate_id, candidate_private in self.zone_index.get(suffix, list()):
+                if private is None or candidate_private == private:
+                    zone_id = candidate_id
+                    break
+            if zone_id:
+                break
+        self.zone_cache[key] = zone_id
+        return zone_id
 
-    def update_host(self, zone_id, hostname, ip, ptr=False):
-        self._operate_record("upsert", zone_id, hostname, "A", ip)
+    def get_zone_id(self, name, private):
+        """Return ID of hosted zone name of view type, reverse zones may be of any"""
+        for zone_id, zone_private in self.zone_index.get(name, list()):
+            if zone_private == private or name.endswith(".arpa."):
+                return zone_id
+        self.misc.die("Hosted zone {} not found".format(name))
 
-    def add_ptr(self, zone_id, ptr_name, hostname):
-        self._operate_record("create", zone_id, ptr_name, "PTR", self._ensure_fqdn(hostname))
+    def find_ptr_zone_id(self, ptr_name):
+        """Return ID of reverse zone of PTR record, memoized per prefix"""
+        # Reverse zones may be /8, /16, /24 or classless, so search by suffix
+        return self.find_zone_id(ptr_name.split(".", 1)[-1])
 
-    def delete_ptr(self, zone_id, ptr_name, hostname):
-        self._operate_record("delete", zone_id, ptr_name, "PTR", self._ensure_fqdn(hostname))
+    def iterate_records(self, zone_id, deadline=None):
+        """Yield [name, type, values, TTL] of zone records page by page"""
+        kwargs = {"HostedZoneId": zone_id, "MaxItems": "300"}
+        while True:
+            response = self._call("list_resource_record_sets", deadline, **kwargs)
+            for record_set in response["ResourceRecordSets"]:
+                # Alias record sets have no values of their own
+                values = [ record["Value"]
+                            for record in record_set.get("ResourceRecords", list()) ]
+                yield [record_set["Name"], record_set["Type"], values,
+                        record_set.get("TTL")]
+            if not response["IsTruncated"]:
+                return
+            kwargs["StartRecordName"] = response["NextRecordName"]
+            kwargs["StartRecordType"] = response["NextRecordType"]
+            if "NextRecordIdentifier" in response:
+                kwargs["StartRecordIdentifier"] = response["NextRecordIdentifier"]
+            else:
+                kwargs.pop("StartRecordIdentifier", None)
 
-    def update_ptr(self, zone_id, ptr_name, hostname):
-        self._operate_record("upsert", zone_id, ptr_name, "PTR", self._ensure_fqdn(hostname))
+    def get_record_set(self, zone_id, rdname, rdtype, deadline=None):
+        """Return [values, TTL] of record set or None if it doesn't exist"""
+        response = self._call(
+            "list_resource_record_sets", deadline,
+            HostedZoneId=zone_id, StartRecordName=rdname,
+            StartRecordType=rdtype, MaxItems="1")
+        for record_set in response["ResourceRecordSets"]:
+            if (record_set["Name"] == self._ensure_fqdn(rdname)
+                and record_set["Type"] == rdtype):
+                values = [ record["Value"]
+                            for record in record_set.get("ResourceRecords", list()) ]
+                return [values, record_set.get("TTL")]
+        return None
 
-    def add_alias(self, zone_id, cname, hostname):
-        self._operate_record("create", zone_id, cname, "CNAME", self._ensure_fqdn(hostname))
+    def add_host(self, zone_id, hostname, ip, ptr=False, deadline=None):
+        self._operate_record("create", zone_id, hostname, "A", ip, deadline)
 
-    def delete_alias(self, zone_id, cname, hostname):
-        self._operate_record("delete", zone_id, cname, "CNAME", self._ensure_fqdn(hostname))
+    def delete_host(self, zone_id, hostname, ip, ptr=False, deadline=None):
+        self._operate_record("delete", zone_id, hostname, "A", ip, deadline)
 
-    def update_alias(self, zone_id, cname, hostname):
-        self._operate_record("upsert", zone_id, cname, "CNAME", self._ensure_fqdn(hostname))
+    def update_host(self, zone_id, hostname, ip, ptr=False, deadline=None):
+        self._operate_record("upsert", zone_id, hostname, "A", ip, deadline)
 
-    def _operate_record(self, action, zone_id, rdname, rdtype, data):
+    def add_ptr(self, zone_id, ptr_name, hostname, deadline=None):
+        self._operate_record("create", zone_id, ptr_name, "PTR", self._ensure_fqdn(hostname), deadline)
+
+    def delete_ptr(self, zone_id, ptr_name, hostname, deadline=None):
+        self._operate_record("delete", zone_id, ptr_name, "PTR", self._ensure_fqdn(hostname), deadline)
+
+    def update_ptr(self, zone_id, ptr_name, hostname, deadline=None):
+        self._operate_record("upsert", zone_id, ptr_name, "PTR", self._ensure_fqdn(hostname), deadline)
+
+    def add_alias(self, zone_id, cname, hostname, deadline=None):
+        self._operate_record("create", zone_id, cname, "CNAME", self._ensure_fqdn(hostname), deadline)
+
+    def delete_alias(self, zone_id, cname, hostname, deadline=None):
+        self._operate_record("delete", zone_id, cname, "CNAME", self._ensure_fqdn(hostname), deadline)
+
+    def update_alias(self, zone_id, cname, hostname, deadline=None):
+        self._operate_record("upsert", zone_id, cname, "CNAME", self._ensure_fqdn(hostname), deadline)
+
+    def update_records(self, zone_id, records, deadline=None):
+        """Upsert records sending one change batch"""
+        self._operate_records("upsert", zone_id, records, deadline)
+
+    def delete_records(self, zone_id, records, deadline=None):
+        """Delete records sending one change batch"""
+        self._operate_records("delete", zone_id, records, deadline)
+
+    def _operate_records(self, action, zone_id, records, deadline=None):
+        action = action.upper()
+        if not action in ["CREATE", "DELETE", "UPSERT"]:
+            self.misc.die("{} with DNS record isn't supported".format(action))
+
+        changes = list()
+        for record in records:
+            # Record may carry its TTL, deletes must match it exactly
+            rdname, rdtype, data = record[:3]
+            ttl = None
+            if len(record) > 3:
+                ttl = record[3]
+            self.logger.debug("Adding %s of '%s':'%s' record with data '%s' to batch.",
+                action, rdtype, rdname, data)
+            changes.append(self._compile_change(action, rdname, rdtype, data, ttl))
+        self._send_changes(zone_id, changes, deadline)
+
+    def _operate_record(self, action, zone_id, rdname, rdtype, data, deadline=None):
         action = action.upper()
         if not action in ["CREATE", "DELETE", "UPSERT"]:
             self.misc.die("{} with DNS record isn't supported".format(action))
 
-        self.logger.debug("Requesting {} of '{}':'{}' record at {} with data '{}'.".format(
-            action, rdtype, rdname, zone_id, data))
+        self.logger.debug("Requesting %s of '%s':'%s' record at %s with data '%s'.",
+            action, rdtype, rdname, zone_id, data)
+
+        self._send_changes(
+            zone_id, [self._compile_change(action, rdname, rdtype, data)], deadline)
+
+    def _compile_change(self, action, rdname, rdtype, data, ttl=None):
+        if ttl is None:
+            ttl = self.config["ttl"]
+        return {
+            "Action": action,
+            "ResourceRecordSet": {
+                "Name": rdname,
+                "Type": rdtype,
+                "TTL": ttl,
+                "ResourceRecords": [
+                    { "Value": data },
+                ]
+            },
+        }
 
-        response = self.client.change_resource_record_sets(
+    def _send_changes(self, zone_id, changes, deadline=None):
+        response = self._call(
+            "change_resource_record_sets",
+            deadline,
             HostedZoneId=zone_id,
             ChangeBatch={
                 "Comment": "made by dnswatch",
-                "Changes": [
-                    {
-                        "Action": action,
-                        "ResourceRecordSet": {
-                            "Name": rdname,
-                            "Type": rdtype,
-                            "TTL": self.config["ttl"],
-                            "ResourceRecords": [
-                                { "Value": data },
-                            ]
-                        },
-                    },
-                ],
+                "Changes": changes,
             }
         )
 
         request_id = self._extract_id(response["ChangeInfo"]["Id"])
-        self.logger.debug("Request sent: %s." % request_id)
+        self.logger.debug("Request sent: %s.", request_id)
 
         if self.sync:
-            self._wait_request(request_id)
+            self._wait_request(request_id, deadline)
         else:
             self.unchecked_requests.append(request_id)
 
-    def check_request_status(self, request_id=None):
+    def check_request_status(self, request_id=None, deadline=None):
         if request_id:
-            self._wait_request(request_id)
-            self.unchecked_requests(request_id)
-        else:
-            for request_id in self.unchecked_requests:
-                self._wait_request(request_id)
+            if (self._wait_request(request_id, deadline)
+                and request_id in self.unchecked_requests):
                 self.unchecked_requests.remove(request_id)
+        else:
+            # Requests not completed in time are checked again next time
+            for request_id in list(self.unchecked_requests):
+                if self._wait_request(request_id, deadline):
+                    self.unchecked_requests.remove(request_id)
+
+    def _call(self, method, deadline=None, **kwargs):
+        """
+        Call Route53 API method under rate limit.
+        Single call is limited by client timeouts, deadline is checked before it.
+        """
+        attempt = 0
+        while True:
+            self.limiter.acquire(deadline)
+            if deadline:
+                deadline.timeout()
+            try:
+                response = interact(
+                    "route53", "{} {}".format(method, kwargs.get("HostedZoneId", "")),
+                    lambda: getattr(self.client, method)(**kwargs))
+            except botocore.exceptions.ClientError as e:
+                code = e.response["Error"]["Code"]
+                if code in self.THROTTLING_CODES and attempt < self.limiter.retries:
+                    attempt += 1
+                    self.limiter.throttled()
+                    continue
+                raise
+            self.limiter.succeeded()
+            return response
 
     def _ensure_fqdn(self, name):
         """Make a proper FQDN from name"""
@@ -118,6 +261,14 @@ class Route53:
         else:
             return name
 
+    def _index_zones(self, zones):
+        """Index zones by name for lookups by suffix"""
+        self.zone_index = dict()
+        self.zone_cache = dict()
+        for zone_id in sorted(zones.keys()):
+            self.zone_index.setdefault(zones[zone_id]["Name"], list()).append(
+                (zone_id, zones[zone_id]["Private"]))
+
     def _extract_id(self, dirty_id):
         """Delete /prefix from Id returned by Amazon API"""
         if dirty_id[:1] == "/":
@@ -125,13 +276,23 @@ class Route53:
         else:
             return dirty_id
 
-    def _wait_request(self, request_id):
-            self.logger.debug("Checking request: %s." % request_id)
+    def _wait_request(self, request_id, deadline=None):
+            self.logger.debug("Checking request: %s.", request_id)
             waiter = self.client.get_waiter('resource_record_sets_changed')
+            waiter_config = dict()
+            if deadline:
+                # Don't poll longer than deadline allows
+                waiter_config = {
+                    "Delay": self.WAITER_DELAY,
+                    "MaxAttempts": max(1, int(deadline.timeout() // self.WAITER_DELAY))
+                }
             try:
-                waiter.wait(Id=request_id)
-                self.logger.debug("Request completed: %s." % request_id)
+                self.limiter.acquire(deadline)
+                interact(
+                    "route53", "wait {}".format(request_id),
+                    lambda: waiter.wait(Id=request_id, WaiterConfig=waiter_config))
+                self.logger.debug("Request completed: %s.", request_id)
                 return True
             except:
-                self.logger.error("Request failed: %s." % request_id)
+                self.logger.error("Request failed: %s.", request_id)
                 return False
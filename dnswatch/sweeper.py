@@ -0,0 +1,202 @@
+import os
+import time
+import logging
+import dns.reversename
+
+from collections import OrderedDict
+from dnsops import DNSOps
+from route53 import Route53
+from dnsproviders import Provider
+from zonesnapshot import ZoneSnapshot
+from deadline import Deadline
+from misc import Misc
+
+
+class Sweeper:
+    """
+    Delete records left by hosts which died without cleanup.
+
+    A host is considered dead when its heartbeat TXT record is older than
+    sweeper.max_age. Its A/AAAA/TXT records, CNAMEs pointing to it and, in
+    private view, PTRs of its addresses found in reverse zones are deleted
+    in batches. Progress is saved after every batch, so an interrupted sweep
+    continues where it stopped. Every DNS provider is swept on its own.
+    """
+
+    def __init__(self, config):
+        self.logger = logging.getLogger("DNSWatch.Sweeper")
+        self.misc = Misc(self.logger)
+        self.sweeper_config = config["sweeper"]
+        self.zone = config["dnsupdate"]["zone"]
+        self.fqdn_zone = Provider()._ensure_fqdn(self.zone)
+        self.provider = config["dnsupdate"]["provider"]
+        self.view = self.sweeper_config["view"]
+        self.checkpoint_file = os.path.join(
+            self.sweeper_config["state_dir"],
+            "{}-{}-{}.checkpoint".format(self.zone, self.view, self.provider))
+
+        if self.provider == "bind":
+            self.dnso = DNSOps(config["dnsupdate"])
+            self.dnso.setup_key()
+            self.masters = self.dnso.get_masters()[self.view]
+            self.snapshot_file = os.path.join(
+                self.sweeper_config["state_dir"],
+                "{}-{}.snapshot".format(self.zone, self.view))
+        elif self.provider == "route53":
+            self.route = Route53(config["dnsupdate"])
+            self.route.get_zones()
+            self.zone_id = self.route.get_zone_id(self.fqdn_zone, self.view == "private")
+        else:
+            self.misc.die("DNS provider {} isn't supported".format(self.provider))
+
+    def sweep(self):
+        """Find and delete stale records, return number of dead hosts swept"""
+        self.logger.info("Sweeping zone %s (%s view) at %s.", self.zone, self.view,
+            self.provider)
+        records = self._get_records()
+
+        # First pass: owners with outdated heartbeat
+        now = int(time.time())
+        dead = set()
+        for name, rtype, data, ttl in records():
+            if rtype == "TXT":
+                heartbeat = Provider()._parse_heartbeat(data)
+                if heartbeat is not None and now - heartbeat > self.sweeper_config["max_age"]:
+                    dead.add(name)
+        if not dead:
+            self.logger.info("No dead hosts found.")
+            self._clear_checkpoint()
+            return 0
+        self.logger.info("Found %s dead hosts.", len(dead))
+
+        # Second pass: everything belonging to dead owners
+        stale = dict()
+        for name, rtype, data, ttl in records():
+            if name in dead and rtype in ["A", "AAAA", "TXT"]:
+                stale.setdefault(name, list()).append([name, rtype, data, ttl])
+            elif rtype == "CNAME" and data in dead:
+                stale.setdefault(data, list()).append([name, rtype, data, ttl])
+
+        # Resume after last owner swept by interrupted run
+        checkpoint = self._load_checkpoint()
+        batch = list()
+        swept = 0
+        for owner in sorted(stale.keys()):
+            if checkpoint and owner <= checkpoint:
+                continue
+            batch.extend(self._compile_deletes(owner, stale[owner]))
+            swept += 1
+            if len(batch) >= self.sweeper_config["batch"]:
+                self._delete(batch)
+                self._save_checkpoint(owner)
+                batch = list()
+        if batch:
+            self._delete(batch)
+        self._clear_checkpoint()
+
+        self.logger.info("Swept %s dead hosts.", swept)
+        return swept
+
+    def _get_records(self):
+        """Return function yielding [name, type, data, TTL] of zone"""
+        if self.provider == "bind":
+            snapshot = ZoneSnapshot(self.zone)
+            snapshot.load(self.snapshot_file)
+            deadline = Deadline("sweep", self.sweeper_config["timeout"])
+            for master in self.masters:
+                try:
+                    self.dnso.transfer_zone(master, snapshot, deadline)
+                    break
+                except Exception as e:
+                    self.logger.warning("Transfer from %s failed: %s.", master, e)
+            else:
+                self.misc.die("Transfer of {} failed on all masters: {}".format(
+                    self.zone, self.masters))
+            snapshot.save(self.snapshot_file)
+
+            def records():
+                for name, rtype, data in snapshot.iterate():
+                    yield name, rtype, data, None
+        else:
+            def records():
+                deadline = Deadline("sweep", self.sweeper_config["timeout"])
+                for name, rtype, values, ttl in self.route.iterate_records(
+                        self.zone_id, deadline):
+                    for value in values:
+                        yield name, rtype, value, ttl
+        return records
+
+    def _compile_deletes(self, owner, records):
+        """Return (zone, record) pairs to delete for owner"""
+        deletes = list()
+        for name, rtype, data, ttl in records:
+            deletes.append((self._zone_of_owner(), [name, rtype, data, ttl]))
+            # PTRs are published only for private addresses
+            if rtype != "A" or self.view != "private":
+                continue
+
+            ptr_name = str(dns.reversename.from_address(data))
+            if self.provider == "bind":
+                # Update of name out of any zone would fail the whole batch
+                if not self.dnso.find_reverse_zone(ptr_name, self.masters[0]):
+                    continue
+                # Delete of absent record is harmless in DNS UPDATE
+                deletes.append((None, [ptr_name, "PTR", owner, None]))
+            else:
+                ptr_zone_id = self.route.find_ptr_zone_id(ptr_name)
+                if not ptr_zone_id:
+                    continue
+                # Route53 rejects the whole batch if one deleted record is absent
+                record_set = self.route.get_record_set(ptr_zone_id, ptr_name, "PTR")
+                if record_set and owner in record_set[0]:
+                    deletes.append((ptr_zone_id, [ptr_name, "PTR", owner, record_set[1]]))
+        return deletes
+
+    def _zone_of_owner(self):
+        # DNS UPDATE finds origin of each record itself
+        if self.provider == "bind":
+            return None
+        return self.zone_id
+
+    def _delete(self, batch):
+        deadline = Deadline("sweep", self.sweeper_config["timeout"])
+        if self.provider == "bind":
+            records = [ record[:3] for zone, record in batch ]
+            self.logger.info("Deleting %s stale records.", len(records))
+            for master in self.masters:
+                try:
+                    self.dnso.delete_records(master, records, deadline)
+                    return
+                except Exception as e:
+                    self.logger.warning("Delete at %s failed: %s.", master, e)
+            self.misc.die("Delete of stale records failed on all masters: {}".format(
+                self.masters))
+        else:
+            zones = OrderedDict()
+            for zone_id, record in batch:
+                zones.setdefault(zone_id, list()).append(record)
+            for zone_id, records in zones.iteritems():
+                self.logger.info("Deleting %s stale records from zone %s.",
+                    len(records), zone_id)
+                self.route.delete_records(zone_id, records, deadline)
+
+    def _load_checkpoint(self):
+        if not os.path.isfile(self.checkpoint_file):
+            return None
+        with open(self.checkpoint_file, "r") as cf:
+            checkpoint = cf.read().strip()
+        self.logger.info("Resuming sweep after %s.", checkpoint)
+        return checkpoint
+
+    def _save_checkpoint(self, owner):
+        checkpoint_dir = os.path.dirname(self.checkpoint_file)
+        if not os.path.isdir(checkpoint_dir):
+            os.makedirs(checkpoint_dir)
+        tmp_file = "{}.tmp".format(self.checkpoint_file)
+        with open(tmp_file, "w") as cf:
+            cf.write("{}\n".format(owner))
+        os.rename(tmp_file, self.checkpoint_file)
+
+    def _clear_checkpoint(self):
+        if os.path.isfile(self.checkpoint_file):
+            os.remove(self.checkpoint_file)
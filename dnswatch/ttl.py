@@ -0,0 +1,46 @@
+import time
+import logging
+
+
+class TTLPolicy:
+    """
+    Adaptive TTL of published records.
+
+    Record gets minimal TTL when it's new or its data changed. While data
+    stays the same, TTL grows by factor each time the record has been
+    stable for as long as the next TTL, up to maximal TTL. So TTL changes
+    (and records get republished) only a few times in a record's life.
+    Without it every record gets static TTL.
+    """
+
+    def __init__(self, config, ttl):
+        self.logger = logging.getLogger("DNSWatch.TTLPolicy")
+        self.enabled = config["enabled"]
+        self.ttl = int(ttl)
+        self.min_ttl = int(config["min"])
+        self.max_ttl = int(config["max"])
+        self.factor = float(config["factor"])
+
+    def apply(self, records, published, since):
+        """Set TTL as 4th item of every record of ordered dict"""
+        now = int(time.time())
+        for key, record in records.iteritems():
+            old = published.get(key)
+            if not self.enabled:
+                # Journaled TTL makes change of static one a difference too
+                ttl = self.ttl
+            elif not old or old[:3] != record[:3] or not key in since:
+                ttl = self.min_ttl
+            else:
+                ttl = self.get_ttl(now - since[key])
+            records[key] = record[:3] + [ttl]
+
+    def get_ttl(self, age):
+        """Return TTL of record having the same data for age seconds"""
+        ttl = self.min_ttl
+        while ttl < self.max_ttl:
+            next_ttl = min(self.max_ttl, int(ttl * self.factor))
+            if next_ttl <= ttl or age < next_ttl:
+                break
+            ttl = next_ttl
+        return ttl
@@ -0,0 +1,166 @@
+import os
+import json
+import tempfile
+import logging
+import dns.name
+import dns.rdatatype
+
+from misc import Misc
+
+
+class ZoneSnapshot:
+    """
+    In-memory copy of a zone: name -> type -> set of record data.
+
+    Filled by AXFR and refreshed by IXFR from the last known serial,
+    so diffs of large zones cost one transfer plus deltas instead of
+    a query per record. Names and data are kept absolute.
+    """
+
+    def __init__(self, origin):
+        self.logger = logging.getLogger("DNSWatch.ZoneSnapshot")
+        self.misc = Misc(self.logger)
+        self.origin = dns.name.from_text(origin).to_text()
+        self.serial = None
+        self.records = dict()
+
+    def apply_transfer(self, messages, incremental=False):
+        """Apply messages of AXFR or IXFR (incremental=True) response"""
+        items = self._iterate(messages)
+        try:
+            name, rtype, rdata = next(items)
+        except StopIteration:
+            self.misc.die("Empty transfer of zone {}".format(self.origin))
+        if rtype != "SOA":
+            self.misc.die("Transfer of zone {} doesn't start with SOA".format(self.origin))
+        new_serial = rdata.serial
+        first_soa = (name, rtype, rdata.to_text())
+
+        try:
+            second = next(items)
+        except StopIteration:
+            # Single SOA: nothing changed since our serial
+            self.logger.debug("Zone %s is up to date at serial %s.",
+                self.origin, self.serial)
+            return
+
+        if not incremental or second[1] != "SOA":
+            # Full zone (server may answer IXFR with AXFR)
+            self.logger.debug("Loading full zone %s at serial %s.",
+                self.origin, new_serial)
+            self.records = dict()
+            self._add(*first_soa)
+            self._add(second[0], second[1], second[2].to_text())
+            for name, rtype, rdata in items:
+                # Transfer ends with the same SOA it starts with
+                if rtype != "SOA":
+                    self._add(name, rtype, rdata.to_text())
+        else:
+            self.logger.debug("Applying changes of zone %s: %s -> %s.",
+                self.origin, self.serial, new_serial)
+            # Sequences of: old SOA, deleted records, new SOA, added records
+            deleting = True
+            self._remove(second[0], second[1], second[2].to_text())
+            for name, rtype, rdata in items:
+                if rtype == "SOA":
+                    deleting = not deleting
+                    if deleting:
+                        self._remove(name, rtype, rdata.to_text())
+                    else:
+                        self._add(name, rtype, rdata.to_text())
+                elif deleting:
+                    self._remove(name, rtype, rdata.to_text())
+                else:
+                    self._add(name, rtype, rdata.to_text())
+            # Keep only the latest SOA
+            self.records.get(self.origin, {}).pop("SOA", None)
+            self._add(*first_soa)
+
+        self.serial = new_serial
+
+    def lookup(self, name, rtype):
+        """Return set of data of name records of type"""
+        return set(self.records.get(self._absolute(name), {}).get(rtype, ()))
+
+    def iterate(self):
+        """Yield all records as [name, type, data]"""
+        for name, rtypes in self.records.iteritems():
+            for rtype, datas in rtypes.iteritems():
+                for data in datas:
+                    yield [name, rtype, data]
+
+    def diff(self, records):
+        """Return records which are missing in zone"""
+        return [ [name, rtype, data] for name, rtype, data in records
+                    if not data in self.lookup(name, rtype) ]
+
+    def save(self, snapshot_file):
+        """Write snapshot atomically"""
+        snapshot_dir = os.path.dirname(snapshot_file)
+        if snapshot_dir and not os.path.isdir(snapshot_dir):
+            os.makedirs(snapshot_dir)
+
+        state = {
+            "origin": self.origin,
+            "serial": self.serial,
+            "records": dict(
+                (name, dict((rtype, sorted(datas)) for rtype, datas in rtypes.iteritems()))
+                    for name, rtypes in self.records.iteritems())
+        }
+        fd, tmp_file = tempfile.mkstemp(dir=snapshot_dir or ".", prefix=".snapshot-")
+        try:
+            with os.fdopen(fd, "w") as sf:
+                json.dump(state, sf)
+            os.rename(tmp_file, snapshot_file)
+        except:
+            if os.path.exists(tmp_file):
+                os.remove(tmp_file)
+            raise
+
+    def load(self, snapshot_file):
+        """Read snapshot saved before, return True if it's usable"""
+        try:
+            with open(snapshot_file, "r") as sf:
+                state = json.load(sf)
+        except (IOError, ValueError) as e:
+            self.logger.debug("Failed to load snapshot %s: %s.", snapshot_file, e)
+            return False
+        if state["origin"] != self.origin:
+            self.logger.warning("Snapshot %s is of other zone: %s.",
+                snapshot_file, state["origin"])
+            return False
+
+        self.serial = state["serial"]
+        self.records = dict()
+        for name, rtypes in state["records"].iteritems():
+            for rtype, datas in rtypes.iteritems():
+                for data in datas:
+                    self._add(name, rtype, data)
+        return True
+
+    def _iterate(self, messages):
+        for message in messages:
+            for rrset in message.answer:
+                name = rrset.name.to_text()
+                rtype = dns.rdatatype.to_text(rrset.rdtype)
+                for rdata in rrset:
+                    yield name, rtype, rdata
+
+    def _add(self, name, rtype, data):
+        # Names and types repeat a lot, keep one copy of each
+        name = intern(str(name))
+        rtype = intern(str(rtype))
+        self.records.setdefault(name, dict()).setdefault(rtype, set()).add(str(data))
+
+    def _remove(self, name, rtype, data):
+        rtypes = self.records.get(name)
+        if not rtypes or not rtype in rtypes:
+            return
+        rtypes[rtype].discard(str(data))
+        if not rtypes[rtype]:
+            rtypes.pop(rtype)
+        if not rtypes:
+            self.records.pop(name)
+
+    def _absolute(self, name):
+        return dns.name.from_text(name).to_text()